@@ -1,12 +1,28 @@
 import streamlit as st
-import pandas as pd
 import os
-import qrcode
-from PIL import Image
 import random
 import datetime
-from io import BytesIO
-import requests
+import csv
+import atexit
+import cProfile
+import hmac
+import io
+import pstats
+import time
+# pandas, requests, qrcode and PIL are imported by the functions that need
+# them, so the login page never pays for them.
+import metrics
+from avatars import AvatarPipeline
+from drugs import DrugIndex, DrugInfoClient, LabelCache, OPENFDA_LABEL_URL
+from interactions import InteractionChecker, current_medications_frame
+from medications import MEDICATION_LISTS, MedicationIndex, split_medications
+from reports import BlobStore, ReportStore
+from search import ReportIndexer, ReportSearchIndex
+from share import QRCodeCache, ShareTokenSigner, load_or_create_secret
+from storage import PATIENT_COLUMNS, PatientIdSequence, max_patient_number, open_patient_store
+
+# Streamlit re-executes this whole file on every interaction.
+rerun_start = time.perf_counter()
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(
@@ -19,95 +35,205 @@ st.set_page_config(
 DATA_DIR = "data"
 PATIENTS_CSV_PATH = os.path.join(DATA_DIR, "patients.csv")
 UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
+MANIFESTS_DIR = os.path.join(DATA_DIR, "manifests")
+BLOBS_DIR = os.path.join(DATA_DIR, "blobs")
+AVATARS_DIR = os.path.join(DATA_DIR, "avatars")
+SEARCH_INDEX_DIR = os.path.join(DATA_DIR, "search_index")
 DRUG_MAP_CSV_PATH = os.path.join(DATA_DIR, "drug_map.csv") 
+PATIENT_ID_SEQ_PATH = os.path.join(DATA_DIR, "patient_id.seq")
+STORAGE_BACKEND = os.environ.get("MEDVAULT_STORAGE_BACKEND", "csv")
+LABEL_CACHE_DB_PATH = os.path.join(DATA_DIR, "openfda_cache.db")
+MEDICATIONS_DB_PATH = os.path.join(DATA_DIR, "medications.db")
+INTERACTION_RULES_PATH = os.path.join(DATA_DIR, "interaction_rules.csv")
+OPENFDA_URL = os.environ.get("MEDVAULT_OPENFDA_URL", OPENFDA_LABEL_URL)
+OFFLINE_MODE = os.environ.get("MEDVAULT_OFFLINE", "").lower() in ("1", "true", "yes")
+METRICS_DIR = os.path.join(DATA_DIR, "metrics")
+# One file per server process so workers don't overwrite each other.
+METRICS_TEXTFILE_PATH = os.environ.get("MEDVAULT_METRICS_FILE", os.path.join(METRICS_DIR, metrics.textfile_name("medvault")))
+METRICS_WRITE_INTERVAL = 5
+ADMIN_TOKEN = os.environ.get("MEDVAULT_ADMIN_TOKEN", "")
+SHARE_SECRET = os.environ.get("MEDVAULT_SHARE_SECRET", "")
+SHARE_SECRET_PATH = os.path.join(DATA_DIR, "share_secret.key")
+SHARE_BASE_URL = os.environ.get("MEDVAULT_BASE_URL", "https://medvault.streamlit.app")
+# How long another worker may keep serving a shared record after its links were revoked.
+SHARED_RECORD_TTL = 60
 
 LOGO_PATH = "medvault_logo.png"
-
-os.makedirs(UPLOADS_DIR, exist_ok=True)
-if not os.path.exists(PATIENTS_CSV_PATH):
-    pd.DataFrame(columns=['patient_id', 'name', 'dob', 'blood_group', 'current_medications', 'medication_history', 'pin']).to_csv(PATIENTS_CSV_PATH, index=False)
-if not os.path.exists(DRUG_MAP_CSV_PATH):
-     pd.DataFrame({
-         'indian_name': ['paracetamol', 'crocin', 'calpol', 'dolo', 'combiflam', 'brufen', 'ibuprofen', 'aspirin', 'disprin', 'benadryl'],
-         'us_name': ['acetaminophen', 'acetaminophen', 'acetaminophen', 'acetaminophen', 'ibuprofen', 'ibuprofen', 'ibuprofen', 'aspirin', 'aspirin', 'diphenhydramine']
-     }).to_csv(DRUG_MAP_CSV_PATH, index=False)
+DEFAULT_AVATAR_PATH = "default_avatar.png"
+REPORTS_PAGE_SIZE = 10
+
+DEFAULT_DRUG_MAP = {
+    'paracetamol': 'acetaminophen', 'crocin': 'acetaminophen', 'calpol': 'acetaminophen', 'dolo': 'acetaminophen',
+    'combiflam': 'ibuprofen', 'brufen': 'ibuprofen', 'ibuprofen': 'ibuprofen',
+    'aspirin': 'aspirin', 'disprin': 'aspirin', 'benadryl': 'diphenhydramine',
+}
+
+@st.cache_resource
+def bootstrap():
+    # Runs once per server process rather than on every rerun.
+    with metrics.time_block('medvault_bootstrap_seconds'):
+        os.makedirs(UPLOADS_DIR, exist_ok=True)
+        if not os.path.exists(PATIENTS_CSV_PATH):
+            with open(PATIENTS_CSV_PATH, 'w', newline='', encoding='utf-8') as f:
+                csv.writer(f, lineterminator='\n').writerow(PATIENT_COLUMNS)
+        if not os.path.exists(DRUG_MAP_CSV_PATH):
+            with open(DRUG_MAP_CSV_PATH, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f, lineterminator='\n')
+                writer.writerow(['indian_name', 'us_name'])
+                writer.writerows(DEFAULT_DRUG_MAP.items())
+        # Per-process metrics files: drop those left by dead workers, and this one's on exit.
+        metrics.remove_stale_textfiles(METRICS_DIR, "medvault")
+        atexit.register(metrics.remove_textfile, METRICS_TEXTFILE_PATH)
+
+bootstrap()
 
 # --- HELPER FUNCTIONS ---
-def load_patients_df():
-    return pd.read_csv(PATIENTS_CSV_PATH, dtype={'pin': str}).fillna('')
-
-def save_patients_df(df):
-    df.to_csv(PATIENTS_CSV_PATH, index=False)
+@st.cache_resource
+def get_patient_store():
+    # One store per server process, shared by every session.
+    return open_patient_store(STORAGE_BACKEND, DATA_DIR)
 
-# --- FIX: Rewritten function for robust ID generation on cloud platforms ---
-def generate_patient_id(df):
-    """
-    Generates a new patient ID by checking the max ID from both the 
-    patients.csv file and the existing folder names in the uploads directory.
-    This makes it resilient to ephemeral filesystem issues on cloud platforms.
-    """
-    max_csv_id = 0
-    if not df.empty and 'patient_id' in df.columns and not df['patient_id'].dropna().empty:
-        csv_ids = df['patient_id'].str.replace("PAT", "").astype(int)
-        max_csv_id = csv_ids.max()
+@st.cache_resource
+def get_patient_id_sequence():
+    return PatientIdSequence(PATIENT_ID_SEQ_PATH, seed=lambda: max_patient_number(get_patient_store(), UPLOADS_DIR))
 
-    max_folder_id = 0
-    try:
-        folder_names = os.listdir(UPLOADS_DIR)
-        folder_ids = [int(name.replace("PAT", "")) for name in folder_names if name.startswith("PAT")]
-        if folder_ids:
-            max_folder_id = max(folder_ids)
-    except (ValueError, FileNotFoundError):
-        max_folder_id = 0
-        
-    last_num = max(max_csv_id, max_folder_id)
-    new_num = last_num + 1
-    return f"PAT{new_num:03d}"
+def generate_patient_id():
+    return get_patient_id_sequence().next_id()
     
 def authenticate_patient(patient_id, pin):
-    df = load_patients_df()
-    patient_record = df[(df['patient_id'] == patient_id) & (df['pin'] == pin)]
-    if not patient_record.empty:
-        return patient_record.iloc[0].to_dict()
+    patient_record = get_patient_store().get(patient_id)
+    if patient_record and patient_record['pin'] == pin:
+        return patient_record
     return None
     
-def get_patient_files(patient_id):
+@st.cache_resource
+def get_report_store():
+    return ReportStore(UPLOADS_DIR, MANIFESTS_DIR, BlobStore(BLOBS_DIR))
+
+@st.cache_resource
+def get_report_indexer():
+    return ReportIndexer(get_report_store(), ReportSearchIndex(SEARCH_INDEX_DIR))
+
+def save_report(patient_id, uploaded_file):
+    """Stores an upload and queues it for text extraction. Returns the name it was saved under."""
+    file_name = get_report_store().save_report(patient_id, uploaded_file.name, uploaded_file)
+    get_report_indexer().submit(patient_id, file_name)
+    return file_name
+
+@st.cache_resource
+def get_qr_cache():
+    return QRCodeCache()
+
+@st.cache_resource
+def get_share_signer():
+    secret = SHARE_SECRET.encode('utf-8') if SHARE_SECRET else load_or_create_secret(SHARE_SECRET_PATH)
+    return ShareTokenSigner(secret)
+
+def share_generation(record):
+    return int(record.get('share_generation') or 0)
+
+@st.cache_data(ttl=SHARED_RECORD_TTL, max_entries=1024)
+def load_shared_record(patient_id):
+    # Read-only view for share links; the PIN never leaves the store.
+    record = get_patient_store().get(patient_id)
+    if record is None:
+        return None
+    return {col: value for col, value in record.items() if col != 'pin'}
+
+def open_share_token(token):
+    """Returns the read-only patient record a share token grants, or None."""
+    verified = get_share_signer().verify(token)
+    if verified is None:
+        return None
+    patient_id, generation = verified
+    record = load_shared_record(patient_id)
+    if record is None or share_generation(record) != generation:
+        return None
+    return record
+
+def share_url(record):
+    return f"{SHARE_BASE_URL}/?token={get_share_signer().issue(record['patient_id'], share_generation(record))}"
+
+def revoke_share_links(patient_id, changes=None):
+    """Bumps the patient's share generation (plus any other ``changes``), invalidating every issued link."""
+    record = get_patient_store().get(patient_id)
+    changes = dict(changes or {}, share_generation=str(share_generation(record) + 1))
+    updated = get_patient_store().update_patient(patient_id, changes)
+    load_shared_record.clear()
+    get_qr_cache().invalidate(patient_id)
+    return updated
+
+@st.cache_resource
+def get_avatar_pipeline():
+    def record_avatar(patient_id, avatar_path):
+        get_patient_store().update_patient(patient_id, {'avatar': avatar_path})
+    return AvatarPipeline(AVATARS_DIR, on_ready=record_avatar)
+
+@st.cache_data(max_entries=512)
+def load_avatar(avatar_path):
+    # Thumbnail names carry a content hash, so the path alone is a safe cache key.
+    with open(avatar_path, "rb") as f:
+        data = f.read()
+    metrics.inc('medvault_bytes_read_total', len(data), source='avatars')
+    return data
+
+def get_avatar_image(patient_id):
+    record = get_patient_store().get(patient_id) or {}
+    avatar_path = record.get('avatar')
+    if avatar_path:
+        try:
+            return load_avatar(avatar_path)
+        except FileNotFoundError:
+            pass
+    # Pictures uploaded before thumbnails existed get converted once, in the
+    # background. Rendering never writes to the registry.
+    get_avatar_pipeline().backfill(patient_id, os.path.join(UPLOADS_DIR, patient_id))
+    return DEFAULT_AVATAR_PATH
+
+def save_profile_pic(patient_id, uploaded_pic):
     patient_folder = os.path.join(UPLOADS_DIR, patient_id)
-    files_to_exclude = ['profile_pic.png', 'profile_pic.jpg', 'profile_pic.jpeg']
-    if os.path.exists(patient_folder):
-        return [f for f in os.listdir(patient_folder) if f.lower() not in files_to_exclude]
-    return []
+    os.makedirs(patient_folder, exist_ok=True)
+    ext = uploaded_pic.name.split('.')[-1].lower()
+    path = os.path.join(patient_folder, f'profile_pic.{ext}')
+    with open(path, "wb") as f:
+        f.write(uploaded_pic.getbuffer())
+    get_avatar_pipeline().submit(patient_id, path)
+
+@st.cache_resource
+def get_drug_index():
+    return DrugIndex(DRUG_MAP_CSV_PATH)
+
+@st.cache_resource
+def get_drug_info_client():
+    return DrugInfoClient(LabelCache(LABEL_CACHE_DB_PATH), base_url=OPENFDA_URL, offline=OFFLINE_MODE)
+
+def resolve_us_names(drug_names):
+    drug_index = get_drug_index()
+    return {drug_name: drug_index.resolve(drug_name) for drug_name in drug_names}
+
+@metrics.timed('medvault_fetch_drug_info_seconds')
+def fetch_drug_info(drug_name):
+    api_search_term = resolve_us_names([drug_name])[drug_name]
+    return get_drug_info_client().lookup(api_search_term, drug_name)
 
-def load_drug_map():
-    if os.path.exists(DRUG_MAP_CSV_PATH):
-        return pd.read_csv(DRUG_MAP_CSV_PATH)
-    return pd.DataFrame(columns=['indian_name', 'us_name'])
+@metrics.timed('medvault_fetch_drug_info_batch_seconds')
+def fetch_drug_info_batch(drug_names):
+    """Looks up a whole medication list concurrently; returns {drug_name: info}."""
+    return get_drug_info_client().lookup_many(resolve_us_names(drug_names))
 
-@st.cache_data(ttl=3600)
-def fetch_drug_info(drug_name):
-    drug_map_df = load_drug_map()
-    search_term = drug_name.lower()
-    match = drug_map_df[drug_map_df['indian_name'].str.lower() == search_term]
-    
-    api_search_term = match.iloc[0]['us_name'] if not match.empty else drug_name
-    
-    try:
-        url = f"https://api.fda.gov/drug/label.json?search=openfda.brand_name:\"{api_search_term}\"&limit=1"
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        if 'results' in data and data['results']:
-            drug_info = data['results'][0]
-            info = {
-                "Purpose": drug_info.get('purpose', ["Not available"])[0],
-                "Warnings": drug_info.get('warnings', ["Not available"])[0],
-                "Active Ingredient": drug_info.get('active_ingredient', ["Not available"])[0],
-            }
-            return info
-        else:
-            return {"Error": f"No information found for '{drug_name}'."}
-    except requests.exceptions.RequestException:
-        return {"Error": f"Could not connect to the server. Please check your internet connection."}
+@st.cache_resource
+def get_medication_index():
+    index = MedicationIndex(MEDICATIONS_DB_PATH, get_drug_index())
+    index.sync(get_patient_store())
+    return index
+
+@st.cache_resource
+def get_interaction_checker():
+    return InteractionChecker(INTERACTION_RULES_PATH)
+
+def check_interactions(med_names):
+    medication_index = get_medication_index()
+    return get_interaction_checker().check([(name, medication_index.canonical(name)) for name in med_names])
 
 # --- SESSION STATE MANAGEMENT ---
 if 'page' not in st.session_state: st.session_state['page'] = 'login'
@@ -117,13 +243,92 @@ if 'new_profile_info' not in st.session_state: st.session_state['new_profile_inf
 if 'current_med_list' not in st.session_state: st.session_state['current_med_list'] = []
 if 'history_med_list' not in st.session_state: st.session_state['history_med_list'] = []
 if 'meds_loaded' not in st.session_state: st.session_state['meds_loaded'] = False
+if 'interaction_findings' not in st.session_state: st.session_state['interaction_findings'] = None
+if 'medication_details' not in st.session_state: st.session_state['medication_details'] = None
 
 # --- UI DRAWING FUNCTIONS ---
 
+def drug_search_box(label, key):
+    """
+    Type-ahead medicine picker backed by the drug index. Returns the chosen
+    name, the typed text if it matches nothing, or None while empty.
+    """
+    query = st.text_input(label, key=f"{key}_query", placeholder="Start typing a medicine name...").strip()
+    if not query:
+        return None
+    options = [name.capitalize() for name in get_drug_index().search(query)]
+    if query.lower() not in (option.lower() for option in options):
+        options.append(query)
+    return st.selectbox("Matching medicines", options, key=f"{key}_match", label_visibility="collapsed")
+
+def draw_medication_details(med_names):
+    if not med_names:
+        return
+    # Looked up once per medication list and kept for the session, so reruns never wait on openFDA.
+    cached = st.session_state['medication_details']
+    if cached is None or cached[0] != tuple(med_names):
+        cached = st.session_state['medication_details'] = (tuple(med_names), fetch_drug_info_batch(med_names))
+    details_by_med = cached[1]
+    with st.expander("ℹ️ Medication Details"):
+        for med, details in details_by_med.items():
+            st.markdown(f"**{med}**")
+            if "Error" in details:
+                st.caption(details["Error"])
+            else:
+                st.json(details, expanded=False)
+        if any("Error" in details for details in details_by_med.values()):
+            if st.button("Retry Lookups", key="retry_medication_details"):
+                st.session_state['medication_details'] = None
+                st.rerun()
+
+def draw_interaction_warnings(findings):
+    if not findings:
+        st.success("No interactions or duplicate ingredients found in the current medicines.")
+        return
+    for finding in findings:
+        draw = st.error if finding['severity'] == 'high' else st.warning
+        draw(f"**{finding['drug_a']} + {finding['drug_b']}** ({finding['severity']}): {finding['message']}", icon="⚠️")
+
+def draw_report_list(patient_id, key_prefix, empty_message):
+    report_store = get_report_store()
+    page = st.session_state.get(f"{key_prefix}_page", 1)
+    entries, page_count = report_store.page(patient_id, page, REPORTS_PAGE_SIZE)
+    if not entries:
+        st.info(empty_message)
+        return
+    for entry in entries:
+        file_name = entry['name']
+        st.download_button(
+            f"📄 Download {file_name} ({entry['size'] / 1024:,.0f} KB)",
+            # Only read from disk when the button is actually clicked.
+            lambda file_name=file_name: report_store.read_report(patient_id, file_name),
+            file_name, mime=entry['type'], key=f"{key_prefix}_{file_name}"
+        )
+    if page_count > 1:
+        st.number_input("Page", min_value=1, max_value=page_count, value=min(page, page_count), key=f"{key_prefix}_page")
+
+def draw_report_search(patient_id):
+    indexer = get_report_indexer()
+    # Picks up reports uploaded before search existed, or changed since.
+    indexer.backfill(patient_id)
+    query = st.text_input("🔎 Search your reports", key="report_search", placeholder="e.g. hemoglobin, HbA1c")
+    pending = indexer.pending(patient_id)
+    if pending:
+        st.caption(f"Reading {pending} report(s) in the background; results may be incomplete.")
+    if query:
+        results = indexer.search_index.search(patient_id, query)
+        if not results:
+            st.info("No reports match your search.")
+        for result in results:
+            st.markdown(f"**📄 {result['name']}**")
+            st.caption(result['snippet'])
+
 def draw_login_page():
     st.session_state['current_med_list'] = []
     st.session_state['history_med_list'] = []
     st.session_state['meds_loaded'] = False
+    st.session_state['interaction_findings'] = None
+    st.session_state['medication_details'] = None
 
     logo_col1, logo_col2, logo_col3 = st.columns([1, 2, 1])
     with logo_col2:
@@ -135,17 +340,15 @@ def draw_login_page():
     st.markdown("<h2 style='text-align: center; color: grey;'>Your personal health record, accessible anywhere.</h2>", unsafe_allow_html=True)
     st.divider()
 
-    login_token = st.query_params.get("token")
-    if login_token and not st.session_state.get('logged_in_patient'):
-        try:
-            patient_id, pin = login_token.split('_')
-            patient_data = authenticate_patient(patient_id, pin)
-            if patient_data:
-                st.session_state['view_only_patient_data'] = patient_data
-                st.session_state['page'] = 'view_only_dashboard'
-                st.query_params.clear()
-                st.rerun()
-        except (ValueError, IndexError):
+    share_token = st.query_params.get("token")
+    if share_token and not st.session_state.get('logged_in_patient'):
+        patient_data = open_share_token(share_token)
+        if patient_data:
+            st.session_state['view_only_patient_data'] = patient_data
+            st.session_state['page'] = 'view_only_dashboard'
+            st.query_params.clear()
+            st.rerun()
+        else:
             st.error("Invalid or expired QR code link.")
     c1, c2 = st.columns(2)
     with c1:
@@ -184,22 +387,14 @@ def draw_create_profile_page():
 
     with st.container(border=True):
         st.subheader("💊 Build Your Medication Lists")
-        drug_map_df = load_drug_map()
-        known_drugs = ["--- Select a Drug ---"] + sorted(drug_map_df['indian_name'].str.capitalize().tolist()) + ["Other..."]
-        
         c1, c2 = st.columns(2)
         with c1:
             st.write("**Currently Using Medicines**")
-            selected_current_med = st.selectbox("Select to add to current list", options=known_drugs, key="current_med_selector")
-            
-            other_current_med = ""
-            if selected_current_med == "Other...":
-                other_current_med = st.text_input("Enter custom medication name", key="other_current")
+            selected_current_med = drug_search_box("Search to add to current list", key="current_med")
 
             if st.button("Add to Current List"):
-                med_to_add = other_current_med if selected_current_med == "Other..." else selected_current_med
-                if med_to_add and med_to_add != "--- Select a Drug ---" and med_to_add not in st.session_state.current_med_list:
-                    st.session_state.current_med_list.append(med_to_add)
+                if selected_current_med and selected_current_med not in st.session_state.current_med_list:
+                    st.session_state.current_med_list.append(selected_current_med)
             
             if st.session_state.current_med_list:
                 st.write("Current Medication List:")
@@ -213,16 +408,11 @@ def draw_create_profile_page():
                             st.rerun()
         with c2:
             st.write("**Medication History**")
-            selected_history_med = st.selectbox("Select to add to history", options=known_drugs, key="history_med_selector")
-
-            other_history_med = ""
-            if selected_history_med == "Other...":
-                other_history_med = st.text_input("Enter custom medication name", key="other_history")
+            selected_history_med = drug_search_box("Search to add to history", key="history_med")
 
             if st.button("Add to History List"):
-                med_to_add = other_history_med if selected_history_med == "Other..." else selected_history_med
-                if med_to_add and med_to_add != "--- Select a Drug ---" and med_to_add not in st.session_state.history_med_list:
-                    st.session_state.history_med_list.append(med_to_add)
+                if selected_history_med and selected_history_med not in st.session_state.history_med_list:
+                    st.session_state.history_med_list.append(selected_history_med)
 
             if st.session_state.history_med_list:
                 st.write("Medication History List:")
@@ -236,9 +426,9 @@ def draw_create_profile_page():
                             st.rerun()
     
     with st.expander("🔍 Unsure about a medication? Look it up here."):
-        drug_to_lookup = st.selectbox("Select a medication to look up", options=known_drugs, key="create_lookup")
+        drug_to_lookup = drug_search_box("Search for a medication to look up", key="create_lookup")
         if st.button("Look up Info", key="create_lookup_btn"):
-            if drug_to_lookup != "--- Select a Drug ---" and drug_to_lookup != "Other...":
+            if drug_to_lookup:
                 with st.spinner(f"Searching for {drug_to_lookup}..."):
                     drug_details = fetch_drug_info(drug_to_lookup)
                     if "Error" in drug_details:
@@ -247,7 +437,7 @@ def draw_create_profile_page():
                         st.success(f"Information for {drug_to_lookup}:")
                         st.json(drug_details)
             else:
-                st.warning("Please select a specific medication from the list to look up.")
+                st.warning("Please search for a medication to look up.")
 
     st.divider()
 
@@ -263,8 +453,7 @@ def draw_create_profile_page():
             st.error("Please fill in all mandatory fields (*) in the Personal Information section.")
         else:
             with st.spinner("Creating your secure profile..."):
-                patients_df = load_patients_df()
-                patient_id = generate_patient_id(patients_df)
+                patient_id = generate_patient_id()
                 pin = str(random.randint(1000, 9999))
                 
                 current_medications_str = "\n".join(st.session_state.current_med_list)
@@ -275,19 +464,19 @@ def draw_create_profile_page():
                     'blood_group': blood_group, 'current_medications': current_medications_str, 
                     'medication_history': medication_history_str, 'pin': pin
                 }
-                new_df = pd.DataFrame([new_patient_data])
-                patients_df = pd.concat([patients_df, new_df], ignore_index=True)
-                save_patients_df(patients_df)
+                get_medication_index().update_patient(get_patient_store().add_patient(new_patient_data))
                 
                 patient_folder = os.path.join(UPLOADS_DIR, patient_id)
                 os.makedirs(patient_folder, exist_ok=True)
                 if profile_pic:
-                    ext = profile_pic.name.split('.')[-1]
-                    with open(os.path.join(patient_folder, f'profile_pic.{ext}'), "wb") as f: f.write(profile_pic.getbuffer())
+                    save_profile_pic(patient_id, profile_pic)
                 for report in initial_reports:
-                    with open(os.path.join(patient_folder, report.name), "wb") as f: f.write(report.getbuffer())
+                    save_report(patient_id, report)
                 
-                st.session_state['new_profile_info'] = {'patient_id': patient_id, 'pin': pin}
+                st.session_state['new_profile_info'] = {
+                    'patient_id': patient_id, 'pin': pin,
+                    'interactions': check_interactions(st.session_state.current_med_list),
+                }
             st.rerun()
 
     if st.session_state.get('new_profile_info'):
@@ -295,6 +484,9 @@ def draw_create_profile_page():
         st.success("Profile Created Successfully!")
         st.info("Please save your credentials securely:")
         st.code(f"Patient ID: {info['patient_id']}\nPIN: {info['pin']}")
+        if info.get('interactions'):
+            st.subheader("⚠️ Medication Check")
+            draw_interaction_warnings(info['interactions'])
         
         if st.button("Go to Login Page"):
             st.session_state['new_profile_info'] = None
@@ -305,20 +497,16 @@ def draw_dashboard():
     patient = st.session_state['logged_in_patient']
     
     if not st.session_state.get('meds_loaded'):
-        st.session_state.current_med_list = [med for med in str(patient.get('current_medications', '')).splitlines() if med.strip()]
-        st.session_state.history_med_list = [med for med in str(patient.get('medication_history', '')).splitlines() if med.strip()]
+        st.session_state.current_med_list = split_medications(patient.get('current_medications'))
+        st.session_state.history_med_list = split_medications(patient.get('medication_history'))
         st.session_state.meds_loaded = True
+        # Repairs the patient's index rows if a save was interrupted between the two writes.
+        get_medication_index().ensure_patient(get_patient_store().get(patient['patient_id']) or patient)
 
     st.title(f"MedVault Dashboard for {patient['name']}")
     col1, col2 = st.columns([1, 3])
     with col1:
-        profile_pic_path = None
-        for ext in ['png', 'jpg', 'jpeg']:
-            path = os.path.join(UPLOADS_DIR, patient['patient_id'], f'profile_pic.{ext}')
-            if os.path.exists(path):
-                profile_pic_path = path
-                break
-        st.image(profile_pic_path if profile_pic_path else "https://www.iconpacks.net/icons/2/free-user-icon-3296-thumb.png", use_container_width=True)
+        st.image(get_avatar_image(patient['patient_id']), use_container_width=True)
     with col2:
         st.subheader("Your Details")
         m1, m2, m3 = st.columns(3)
@@ -334,22 +522,27 @@ def draw_dashboard():
                 new_current_medications = st.text_area("Currently Using Medicines", value="\n".join(st.session_state.current_med_list))
                 new_medication_history = st.text_area("Medication History", value="\n".join(st.session_state.history_med_list))
                 new_profile_pic = st.file_uploader("Upload new profile picture", type=['png', 'jpg', 'jpeg'])
+                new_pin = st.text_input("New PIN (leave blank to keep the current one)", type="password", max_chars=4).strip()
                 update_submitted = st.form_submit_button("Update Profile")
-                if update_submitted:
+                if update_submitted and new_pin and not (new_pin.isdigit() and len(new_pin) == 4):
+                    st.error("The PIN must be 4 digits.")
+                elif update_submitted:
                     with st.spinner("Saving your changes..."):
-                        df = load_patients_df()
-                        patient_index = df.index[df['patient_id'] == patient['patient_id']].tolist()[0]
-                        df.at[patient_index, 'name'] = new_name
-                        df.at[patient_index, 'dob'] = new_dob.strftime("%Y-%m-%d")
-                        df.at[patient_index, 'blood_group'] = new_blood_group
-                        df.at[patient_index, 'current_medications'] = new_current_medications
-                        df.at[patient_index, 'medication_history'] = new_medication_history
-                        save_patients_df(df)
+                        changes = {
+                            'name': new_name, 'dob': new_dob.strftime("%Y-%m-%d"),
+                            'blood_group': new_blood_group, 'current_medications': new_current_medications,
+                            'medication_history': new_medication_history
+                        }
+                        if new_pin and new_pin != patient['pin']:
+                            # A new PIN also revokes every share link handed out so far.
+                            updated = revoke_share_links(patient['patient_id'], dict(changes, pin=new_pin))
+                        else:
+                            updated = get_patient_store().update_patient(patient['patient_id'], changes)
+                        get_medication_index().update_patient(updated)
+                        st.session_state['interaction_findings'] = check_interactions(split_medications(new_current_medications))
                         if new_profile_pic:
-                            ext = new_profile_pic.name.split('.')[-1]
-                            with open(os.path.join(UPLOADS_DIR, patient['patient_id'], f'profile_pic.{ext}'), "wb") as f:
-                                f.write(new_profile_pic.getbuffer())
-                    st.session_state['logged_in_patient'] = authenticate_patient(patient['patient_id'], patient['pin'])
+                            save_profile_pic(patient['patient_id'], new_profile_pic)
+                    st.session_state['logged_in_patient'] = authenticate_patient(patient['patient_id'], updated['pin'])
                     st.session_state['meds_loaded'] = False # Reload meds on next run
                     st.success("Profile updated successfully!")
                     st.rerun()
@@ -358,37 +551,33 @@ def draw_dashboard():
     med_col, report_col = st.columns(2)
     with med_col:
         st.subheader("💊 Current Medicines")
-        current_meds_list = [med for med in str(patient.get('current_medications', '')).splitlines() if med.strip()]
+        current_meds_list = split_medications(patient.get('current_medications'))
         st.info(", ".join(current_meds_list) if current_meds_list else "No current medications listed.")
+        if st.session_state.get('interaction_findings') is not None:
+            draw_interaction_warnings(st.session_state['interaction_findings'])
         
         st.subheader("📜 Medication History")
-        history_meds_list = [med for med in str(patient.get('medication_history', '')).splitlines() if med.strip()]
+        history_meds_list = split_medications(patient.get('medication_history'))
         st.info(", ".join(history_meds_list) if history_meds_list else "No medication history listed.")
+        draw_medication_details(list(dict.fromkeys(current_meds_list + history_meds_list)))
     with report_col:
         st.subheader("📁 Your Health Reports")
         uploaded_file = st.file_uploader("Upload a new report", type=["pdf", "png", "jpg", "csv"], key="report_uploader")
-        if uploaded_file:
+        # The uploader keeps its file across reruns; only save each upload once.
+        if uploaded_file and st.session_state.get('saved_upload_id') != uploaded_file.file_id:
             with st.spinner(f"Uploading {uploaded_file.name}..."):
-                with open(os.path.join(UPLOADS_DIR, patient['patient_id'], uploaded_file.name), "wb") as f:
-                    f.write(uploaded_file.getbuffer())
+                save_report(patient['patient_id'], uploaded_file)
+            st.session_state['saved_upload_id'] = uploaded_file.file_id
             st.success(f"Report '{uploaded_file.name}' uploaded!")
             st.rerun()
-        patient_files = get_patient_files(patient['patient_id'])
-        if patient_files:
-            for file_name in patient_files:
-                file_path = os.path.join(UPLOADS_DIR, patient['patient_id'], file_name)
-                with open(file_path, "rb") as f:
-                    st.download_button(f"📄 Download {file_name}", f.read(), file_name, key=f"download_dash_{file_name}")
-        else:
-            st.info("No reports uploaded yet.")
+        draw_report_list(patient['patient_id'], "download_dash", "No reports uploaded yet.")
+        draw_report_search(patient['patient_id'])
             
     st.divider()
     with st.expander("🔍 Drug Information Lookup (Supports Indian Names)"):
-        drug_map_df = load_drug_map()
-        known_drugs = ["--- Select a Drug ---"] + sorted(drug_map_df['indian_name'].str.capitalize().tolist())
-        search_term = st.selectbox("Select a common medication to look up", options=known_drugs, key="dash_lookup")
+        search_term = drug_search_box("Search for a medication to look up", key="dash_lookup")
         if st.button("Search for Drug Info"):
-            if search_term != "--- Select a Drug ---":
+            if search_term:
                 with st.spinner(f"Searching for {search_term}..."):
                     drug_details = fetch_drug_info(search_term)
                     if "Error" in drug_details:
@@ -404,17 +593,12 @@ def draw_dashboard():
     with qr_col1:
         st.subheader("📲 Share Your Dashboard")
         st.info("Scan this QR code to get instant, password-less access to a view-only version of this dashboard.")
+        st.caption(f"Links stay valid for about {get_share_signer().ttl // 86400} days. Changing your PIN or resetting the link revokes all earlier ones.")
+        if st.button("🔄 Reset Share Link"):
+            st.session_state['logged_in_patient'] = revoke_share_links(patient['patient_id'])
+            st.rerun()
     with qr_col2:
-        BASE_URL = "https://medvault.streamlit.app" 
-        login_token = f"{patient['patient_id']}_{patient['pin']}"
-        qr_data = f"{BASE_URL}/?token={login_token}"
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white")
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        st.image(buf, use_container_width=True)
+        st.image(get_qr_cache().get(patient['patient_id'], share_url(patient)), use_container_width=True)
 
     if st.button("Logout"):
         st.session_state['page'] = 'login'
@@ -428,13 +612,7 @@ def draw_view_only_dashboard():
     st.title(f"MedVault Dashboard for {patient['name']}")
     col1, col2 = st.columns([1, 3])
     with col1:
-        profile_pic_path = None
-        for ext in ['png', 'jpg', 'jpeg']:
-            path = os.path.join(UPLOADS_DIR, patient['patient_id'], f'profile_pic.{ext}')
-            if os.path.exists(path):
-                profile_pic_path = path
-                break
-        st.image(profile_pic_path if profile_pic_path else "https://www.iconpacks.net/icons/2/free-user-icon-3296-thumb.png", use_container_width=True)
+        st.image(get_avatar_image(patient['patient_id']), use_container_width=True)
     with col2:
         st.subheader("Patient Details")
         m1, m2, m3 = st.columns(3)
@@ -445,22 +623,16 @@ def draw_view_only_dashboard():
     med_col, report_col = st.columns(2)
     with med_col:
         st.subheader("💊 Current Medicines")
-        current_meds_list = [med for med in str(patient.get('current_medications', '')).splitlines() if med.strip()]
+        current_meds_list = split_medications(patient.get('current_medications'))
         st.info(", ".join(current_meds_list) if current_meds_list else "No current medications listed.")
 
         st.subheader("📜 Medication History")
-        history_meds_list = [med for med in str(patient.get('medication_history', '')).splitlines() if med.strip()]
+        history_meds_list = split_medications(patient.get('medication_history'))
         st.info(", ".join(history_meds_list) if history_meds_list else "No medication history listed.")
+        draw_medication_details(list(dict.fromkeys(current_meds_list + history_meds_list)))
     with report_col:
         st.subheader("📁 Health Reports")
-        patient_files = get_patient_files(patient['patient_id'])
-        if patient_files:
-            for file_name in patient_files:
-                file_path = os.path.join(UPLOADS_DIR, patient['patient_id'], file_name)
-                with open(file_path, "rb") as f:
-                    st.download_button(f"📄 Download {file_name}", f.read(), file_name, key=f"download_view_{file_name}")
-        else:
-            st.info("No reports available.")
+        draw_report_list(patient['patient_id'], "download_view", "No reports available.")
     st.divider()
     if st.button("Back to Main Page"):
         st.session_state['page'] = 'login'
@@ -468,14 +640,138 @@ def draw_view_only_dashboard():
         st.session_state['meds_loaded'] = False
         st.rerun()
 
+def draw_admin_sidebar():
+    with st.sidebar:
+        st.subheader("🛠️ Admin")
+        if st.button("Open Metrics"):
+            st.session_state['page'] = 'metrics'
+            st.rerun()
+        if st.button("Medication Query"):
+            st.session_state['page'] = 'medication_query'
+            st.rerun()
+        if st.button("Interaction Sweep"):
+            st.session_state['page'] = 'interaction_sweep'
+            st.rerun()
+        if st.button("Profile Next Rerun"):
+            st.session_state['profile_next_rerun'] = True
+        if st.session_state.get('profile_next_rerun'):
+            st.caption("The next interaction will be profiled.")
+
+def draw_metrics_page():
+    import pandas as pd
+    st.title("📈 MedVault Metrics")
+    st.caption(f"Process {os.getpid()} · Prometheus text file: `{METRICS_TEXTFILE_PATH}`")
+    counters, histograms = metrics.REGISTRY.snapshot()
+    for rows in (counters, histograms):
+        for row in rows:
+            row['labels'] = ", ".join(f"{k}={v}" for k, v in row['labels'].items())
+    st.subheader("Timings")
+    st.dataframe(pd.DataFrame(histograms), use_container_width=True, hide_index=True)
+    st.subheader("Counters")
+    st.dataframe(pd.DataFrame(counters), use_container_width=True, hide_index=True)
+    with st.expander("Prometheus exposition"):
+        st.code(metrics.REGISTRY.render_prometheus(), language="text")
+    if st.session_state.get('last_profile'):
+        with st.expander("Last profiled rerun", expanded=True):
+            st.code(st.session_state['last_profile'], language="text")
+    if st.button("Back to Main Page"):
+        st.session_state['page'] = 'login'
+        st.rerun()
+
+def draw_medication_query_page():
+    import pandas as pd
+    st.title("💊 Medication Query")
+    st.caption("Patients taking a drug under any of its brand names, from the medication index.")
+    medication_index = get_medication_index()
+    drug = drug_search_box("Drug or brand name", key="med_query")
+    list_labels = {'current': "Currently using", 'history': "Medication history"}
+    lists = st.multiselect("Lists", list(MEDICATION_LISTS), default=['current'], format_func=list_labels.get)
+    if drug and lists:
+        start = time.perf_counter()
+        patient_ids = medication_index.patients_on(drug, lists)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        st.metric(f"Patients on {medication_index.canonical(drug)}", len(patient_ids))
+        st.caption(f"Answered in {elapsed_ms:.1f} ms")
+        store = get_patient_store()
+        rows = [{'patient_id': pid, 'name': (store.get(pid) or {}).get('name', '')} for pid in patient_ids[:1000]]
+        st.dataframe(pd.DataFrame(rows, columns=['patient_id', 'name']), use_container_width=True, hide_index=True)
+        if len(patient_ids) > 1000:
+            st.caption(f"Showing the first 1,000 of {len(patient_ids):,}.")
+    st.subheader("Most common current medications")
+    st.dataframe(pd.DataFrame(medication_index.drug_counts('current'), columns=['drug', 'patients']),
+                 use_container_width=True, hide_index=True)
+    if st.button("Back to Main Page"):
+        st.session_state['page'] = 'login'
+        st.rerun()
+
+def draw_interaction_sweep_page():
+    st.title("⚠️ Interaction Sweep")
+    st.caption(f"Screens every patient's current medicines against `{INTERACTION_RULES_PATH}`.")
+    if st.button("Run Sweep", type="primary"):
+        start = time.perf_counter()
+        findings = get_interaction_checker().sweep(current_medications_frame(get_medication_index()))
+        st.session_state['interaction_sweep'] = (findings, time.perf_counter() - start)
+    if st.session_state.get('interaction_sweep') is not None:
+        findings, elapsed = st.session_state['interaction_sweep']
+        c1, c2, c3 = st.columns(3)
+        c1.metric("Findings", len(findings))
+        c2.metric("Patients flagged", findings['patient_id'].nunique())
+        c3.metric("High severity", int((findings['severity'] == 'high').sum()))
+        st.caption(f"Swept in {elapsed:.2f} s")
+        st.dataframe(findings, use_container_width=True, hide_index=True)
+        st.download_button("Download CSV", lambda: findings.to_csv(index=False), "interaction_findings.csv", mime="text/csv")
+    if st.button("Back to Main Page"):
+        st.session_state['page'] = 'login'
+        st.rerun()
+
+def run_profiled(draw_page):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        draw_page()
+    finally:
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+        st.session_state['last_profile'] = out.getvalue()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(METRICS_DIR, f"rerun-{datetime.datetime.now():%Y%m%d-%H%M%S}.prof"))
+
 # --- MAIN ROUTER ---
-if st.session_state['page'] == 'login':
-    draw_login_page()
-elif st.session_state['page'] == 'create_profile':
-    draw_create_profile_page()
-elif st.session_state['page'] == 'dashboard' and st.session_state['logged_in_patient']:
-    draw_dashboard()
-elif st.session_state['page'] == 'view_only_dashboard' and st.session_state['view_only_patient_data']:
-    draw_view_only_dashboard()
-else:
-    draw_login_page()
\ No newline at end of file
+def draw_current_page():
+    if st.session_state['page'] == 'login':
+        draw_login_page()
+    elif st.session_state['page'] == 'create_profile':
+        draw_create_profile_page()
+    elif st.session_state['page'] == 'dashboard' and st.session_state['logged_in_patient']:
+        draw_dashboard()
+    elif st.session_state['page'] == 'view_only_dashboard' and st.session_state['view_only_patient_data']:
+        draw_view_only_dashboard()
+    elif st.session_state['page'] == 'metrics' and st.session_state.get('is_admin'):
+        draw_metrics_page()
+    elif st.session_state['page'] == 'medication_query' and st.session_state.get('is_admin'):
+        draw_medication_query_page()
+    elif st.session_state['page'] == 'interaction_sweep' and st.session_state.get('is_admin'):
+        draw_interaction_sweep_page()
+    else:
+        draw_login_page()
+
+def run_page():
+    with metrics.time_block('medvault_page_render_seconds', page=st.session_state['page']):
+        draw_current_page()
+
+admin_param = st.query_params.get("admin")
+if admin_param and ADMIN_TOKEN and hmac.compare_digest(admin_param, ADMIN_TOKEN):
+    st.session_state['is_admin'] = True
+    del st.query_params["admin"]
+if st.session_state.get('is_admin'):
+    draw_admin_sidebar()
+
+try:
+    if st.session_state.pop('profile_next_rerun', False):
+        run_profiled(run_page)
+    else:
+        run_page()
+finally:
+    metrics.observe('medvault_script_run_seconds', time.perf_counter() - rerun_start)
+    metrics.REGISTRY.write_textfile(METRICS_TEXTFILE_PATH, min_interval=METRICS_WRITE_INTERVAL, pid=os.getpid())
\ No newline at end of file
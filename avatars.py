@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from reports import safe_file_name
+
+logger = logging.getLogger(__name__)
+
+# Thumbnail edge lengths in pixels; AVATAR_DISPLAY_SIZE is the one the
+# dashboards show and the one recorded in the patient record.
+AVATAR_SIZES = (128, 256, 512)
+AVATAR_DISPLAY_SIZE = 512
+AVATAR_JPEG_QUALITY = 85
+
+LEGACY_PROFILE_PIC_EXTS = ('png', 'jpg', 'jpeg')
+
+
+def find_legacy_profile_pic(patient_folder):
+    """Original ``profile_pic.*`` upload in a patient folder, if any."""
+    for ext in LEGACY_PROFILE_PIC_EXTS:
+        path = os.path.join(patient_folder, f'profile_pic.{ext}')
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def make_thumbnails(source_path, out_dir):
+    """
+    Writes square-bounded JPEG thumbnails of ``source_path`` for every size
+    in AVATAR_SIZES and returns ``{size: path}``. Files are named after the
+    source's content hash, so a new picture never collides with a cached one.
+    """
+    from PIL import Image, ImageOps
+    with open(source_path, 'rb') as f:
+        tag = hashlib.sha256(f.read()).hexdigest()[:12]
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    with Image.open(source_path) as img:
+        # Lets the JPEG decoder skip most of a large photo's pixels.
+        img.draft('RGB', (max(AVATAR_SIZES) * 2, max(AVATAR_SIZES) * 2))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, 'white')
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        else:
+            img = img.convert('RGB')
+        for size in sorted(AVATAR_SIZES, reverse=True):
+            img.thumbnail((size, size), Image.LANCZOS)
+            path = os.path.join(out_dir, f'avatar_{size}_{tag}.jpg')
+            img.save(path, 'JPEG', quality=AVATAR_JPEG_QUALITY, optimize=True)
+            paths[size] = path
+    return paths
+
+
+class AvatarPipeline:
+    """
+    Generates avatar thumbnails on a small background pool. ``on_ready`` is
+    called with ``(patient_id, display_path)`` once a patient's thumbnails
+    exist, typically to record the path in the patient record. A picture
+    that cannot be decoded is logged and left alone.
+
+    ``backfill`` converts pictures uploaded before thumbnails existed. It
+    remembers, in memory, patients whose folder has no picture and pictures
+    that failed, so later calls for them cost a set lookup and never touch
+    the disk; a ``submit`` for the patient clears both.
+    """
+
+    def __init__(self, avatars_dir, on_ready, max_workers=2):
+        self.avatars_dir = avatars_dir
+        self.on_ready = on_ready
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='avatars')
+        # patient_id -> number of queued or running jobs.
+        self._pending = {}
+        self._failed = set()
+        self._no_picture = set()
+        self._lock = threading.Lock()
+
+    def _process(self, patient_id, source_path):
+        try:
+            out_dir = os.path.join(self.avatars_dir, safe_file_name(patient_id))
+            try:
+                display_path = make_thumbnails(source_path, out_dir)[AVATAR_DISPLAY_SIZE]
+            except Exception:
+                logger.exception("Could not make avatar thumbnails for %s from %s", patient_id, source_path)
+                metrics.inc('medvault_avatar_failures_total')
+                with self._lock:
+                    self._failed.add(patient_id)
+                return None
+            self.on_ready(patient_id, display_path)
+            return display_path
+        finally:
+            with self._lock:
+                self._pending[patient_id] -= 1
+                if not self._pending[patient_id]:
+                    del self._pending[patient_id]
+
+    def _queue_locked(self, patient_id, source_path):
+        self._pending[patient_id] = self._pending.get(patient_id, 0) + 1
+        return self._executor.submit(self._process, patient_id, source_path)
+
+    def submit(self, patient_id, source_path):
+        """Queues thumbnail generation and returns its Future (resolving to the display path, or None)."""
+        with self._lock:
+            self._failed.discard(patient_id)
+            self._no_picture.discard(patient_id)
+            return self._queue_locked(patient_id, source_path)
+
+    def backfill(self, patient_id, patient_folder):
+        """
+        Queues the legacy ``profile_pic.*`` in ``patient_folder``, if there
+        is one. Returns None when there is nothing to do: no picture, a job
+        for the patient already queued, or the picture already failed.
+        """
+        with self._lock:
+            if patient_id in self._pending or patient_id in self._failed or patient_id in self._no_picture:
+                return None
+        source_path = find_legacy_profile_pic(patient_folder)
+        with self._lock:
+            if source_path is None:
+                self._no_picture.add(patient_id)
+                return None
+            if patient_id in self._pending:
+                return None
+            return self._queue_locked(patient_id, source_path)
@@ -0,0 +1,254 @@
+"""
+Synthetic-load benchmarks for MedVault's data paths, run without Streamlit.
+
+For each scale a registry of that many patients (plus an uploads tree for a
+sample of them) is generated in a temporary directory, then the paths behind
+login, sign-up, profile edits and report listings are timed. Each scale runs
+in a fresh process so peak RSS is per scale. Results are printed as a table
+and can be written as JSON to compare across releases:
+
+    python benchmarks/bench_data_paths.py --scales 10000 100000 1000000 --output results.json
+    python benchmarks/bench_data_paths.py --scales 100000 --backend sqlite --mix-workers 8
+"""
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from reports import BlobStore, ReportStore  # noqa: E402
+from storage import (PATIENT_COLUMNS, STORAGE_BACKENDS, PatientIdSequence, format_patient_id,  # noqa: E402
+                     max_patient_number, migrate, open_patient_store)
+
+BLOOD_GROUPS = ["A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-"]
+DRUG_NAMES = ["Crocin", "Dolo", "Calpol", "Combiflam", "Brufen", "Aspirin", "Disprin", "Benadryl", "Paracetamol"]
+
+
+def generate_dataset(data_dir, patients, upload_patients, reports_per_patient, rng):
+    """Writes data/patients.csv and data/uploads/ for a synthetic registry."""
+    os.makedirs(os.path.join(data_dir, 'uploads'), exist_ok=True)
+    with open(os.path.join(data_dir, 'patients.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(PATIENT_COLUMNS)
+        for n in range(1, patients + 1):
+            dob = datetime.date(1930, 1, 1) + datetime.timedelta(days=rng.randrange(33000))
+            writer.writerow([
+                format_patient_id(n), f"Patient {n}", dob.isoformat(), rng.choice(BLOOD_GROUPS),
+                "\n".join(rng.sample(DRUG_NAMES, rng.randrange(4))),
+                "\n".join(rng.sample(DRUG_NAMES, rng.randrange(3))),
+                str(rng.randint(1000, 9999)), '',
+            ])
+    for n in rng.sample(range(1, patients + 1), min(upload_patients, patients)):
+        folder = os.path.join(data_dir, 'uploads', format_patient_id(n))
+        os.makedirs(folder)
+        for i in range(reports_per_patient):
+            with open(os.path.join(folder, f"report_{i}.pdf"), 'wb') as f:
+                f.write(os.urandom(rng.randrange(1024, 16384)))
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'n': 0}
+
+    def pct(p):
+        return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))] * 1000
+
+    return {
+        'n': len(samples),
+        'p50_ms': round(pct(50), 4),
+        'p95_ms': round(pct(95), 4),
+        'max_ms': round(samples[-1] * 1000, 4),
+    }
+
+
+def timed(fn, args_list):
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_scale(patients, backend, iterations, upload_patients, reports_per_patient, seed):
+    rng = random.Random(seed)
+    data_dir = tempfile.mkdtemp(prefix=f'medvault-bench-{patients}-')
+    uploads_dir = os.path.join(data_dir, 'uploads')
+    try:
+        result = {'patients': patients, 'backend': backend, 'paths': {}}
+        start = time.perf_counter()
+        generate_dataset(data_dir, patients, upload_patients, reports_per_patient, rng)
+        if backend != 'csv':
+            migrate('csv', backend, data_dir)
+        result['generate_s'] = round(time.perf_counter() - start, 3)
+
+        store = open_patient_store(backend, data_dir)
+        start = time.perf_counter()
+        len(store)
+        result['paths']['cold_load'] = summarize([time.perf_counter() - start])
+
+        sample_ids = [format_patient_id(rng.randint(1, patients)) for _ in range(iterations)]
+
+        def authenticate(patient_id, pin):
+            record = store.get(patient_id)
+            return record if record and record['pin'] == pin else None
+
+        result['paths']['authenticate_patient'] = summarize(timed(authenticate, [(pid, '0000') for pid in sample_ids]))
+
+        sequence = PatientIdSequence(os.path.join(data_dir, 'patient_id.seq'), seed=lambda: max_patient_number(store, uploads_dir))
+        result['paths']['generate_patient_id'] = summarize(timed(sequence.next_id, [()] * iterations))
+
+        def create_profile():
+            store.add_patient({
+                'patient_id': sequence.next_id(), 'name': 'Bench', 'dob': '1990-01-01',
+                'blood_group': rng.choice(BLOOD_GROUPS), 'current_medications': 'Crocin', 'pin': '1234',
+            })
+
+        result['paths']['profile_creation'] = summarize(timed(create_profile, [()] * iterations))
+
+        def update_profile(patient_id):
+            store.update_patient(patient_id, {'name': 'Updated', 'current_medications': 'Dolo\nBrufen'})
+
+        result['paths']['profile_update'] = summarize(timed(update_profile, [(pid,) for pid in sample_ids]))
+
+        report_store = ReportStore(uploads_dir, os.path.join(data_dir, 'manifests'), BlobStore(os.path.join(data_dir, 'blobs')))
+        upload_ids = os.listdir(uploads_dir) or [sample_ids[0]]
+        listing_ids = [(rng.choice(upload_ids),) for _ in range(iterations)]
+        result['paths']['get_patient_files_cold'] = summarize(timed(report_store.manifest, listing_ids))
+        result['paths']['get_patient_files'] = summarize(timed(report_store.manifest, listing_ids))
+
+        def upload_report(patient_id):
+            report_store.save_report(patient_id, 'lab.pdf', io.BytesIO(os.urandom(8192)))
+
+        result['paths']['report_upload'] = summarize(timed(upload_report, listing_ids[:max(1, iterations // 10)]))
+        result['peak_rss_mb'] = peak_rss_mb()
+        return result
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _mix_worker(data_dir, backend, operations, signup_ratio, patients, seed):
+    rng = random.Random(seed)
+    store = open_patient_store(backend, data_dir)
+    sequence = PatientIdSequence(os.path.join(data_dir, 'patient_id.seq'), seed=lambda: patients)
+    created, signups, logins = [], [], []
+    for _ in range(operations):
+        start = time.perf_counter()
+        if rng.random() < signup_ratio:
+            patient_id = sequence.next_id()
+            store.add_patient({'patient_id': patient_id, 'name': 'Mix', 'dob': '1990-01-01', 'pin': '1234'})
+            created.append(patient_id)
+            signups.append(time.perf_counter() - start)
+        else:
+            record = store.get(format_patient_id(rng.randint(1, patients)))
+            _ = record and record['pin'] == '1234'
+            logins.append(time.perf_counter() - start)
+    return created, signups, logins
+
+
+def replay_mix(patients, backend, workers, operations, signup_ratio, seed):
+    """Concurrent sign-up/login mix across ``workers`` processes sharing one data dir."""
+    rng = random.Random(seed)
+    data_dir = tempfile.mkdtemp(prefix='medvault-mix-')
+    try:
+        generate_dataset(data_dir, patients, 0, 0, rng)
+        if backend != 'csv':
+            migrate('csv', backend, data_dir)
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_mix_worker, data_dir, backend, operations, signup_ratio, patients, seed + i)
+                       for i in range(workers)]
+            outcomes = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+        created = [pid for outcome in outcomes for pid in outcome[0]]
+        store = open_patient_store(backend, data_dir)
+        return {
+            'patients': patients, 'backend': backend, 'workers': workers,
+            'operations': workers * operations, 'signup_ratio': signup_ratio,
+            'throughput_ops_s': round(workers * operations / elapsed, 1),
+            'signup': summarize([s for outcome in outcomes for s in outcome[1]]),
+            'login': summarize([s for outcome in outcomes for s in outcome[2]]),
+            'duplicate_ids': len(created) - len(set(created)),
+            'lost_signups': len(created) - sum(1 for pid in set(created) if store.get(pid)),
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark MedVault data paths on synthetic registries.")
+    parser.add_argument('--scales', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--backend', choices=STORAGE_BACKENDS, default='csv')
+    parser.add_argument('--iterations', type=int, default=200, help="timed calls per path")
+    parser.add_argument('--upload-patients', type=int, default=1000, help="patients given an uploads folder")
+    parser.add_argument('--reports-per-patient', type=int, default=5)
+    parser.add_argument('--mix-workers', type=int, default=0, help="processes for the concurrent sign-up/login replay (0 = skip)")
+    parser.add_argument('--mix-operations', type=int, default=500, help="operations per replay worker")
+    parser.add_argument('--signup-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="write results as JSON to this path")
+    args = parser.parse_args(argv)
+
+    results = {
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'config': vars(args),
+        'scales': [],
+        'mix': [],
+    }
+    for patients in args.scales:
+        # A fresh process per scale keeps peak RSS from carrying over.
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            result = pool.submit(run_scale, patients, args.backend, args.iterations, args.upload_patients,
+                                 args.reports_per_patient, args.seed).result()
+        results['scales'].append(result)
+        print(f"\n{patients:,} patients ({args.backend}): generated in {result['generate_s']}s, peak RSS {result['peak_rss_mb']} MB")
+        for path, stats in result['paths'].items():
+            print(f"  {path:<24} p50 {stats['p50_ms']:>10.3f} ms   p95 {stats['p95_ms']:>10.3f} ms   (n={stats['n']})")
+        if args.mix_workers:
+            mix = replay_mix(patients, args.backend, args.mix_workers, args.mix_operations, args.signup_ratio, args.seed)
+            results['mix'].append(mix)
+            print(f"  mix x{mix['workers']}: {mix['throughput_ops_s']} ops/s, sign-up p95 {mix['signup'].get('p95_ms')} ms, "
+                  f"login p95 {mix['login'].get('p95_ms')} ms, duplicate IDs {mix['duplicate_ids']}, lost sign-ups {mix['lost_signups']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Startup benchmark for the Streamlit app, run headless through
+streamlit.testing.
+
+Each sample starts a fresh interpreter (spawned, so nothing is inherited from
+this process) with an empty working directory, runs app.py once (the cold
+start: module imports plus first-run bootstrap) and then reruns the login
+page a number of times. The per-rerun overhead every interaction pays is
+taken from the app's own ``medvault_script_run_seconds`` metric, since the
+test harness adds its own polling delay to each run. It also records which
+heavy third-party modules the login page loaded.
+
+    python benchmarks/bench_startup.py --samples 5 --reruns 50 --output startup.json
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('pandas', 'numpy', 'pyarrow', 'requests', 'PIL', 'qrcode')
+
+
+def _script_seconds(registry):
+    for histogram in registry.snapshot()[1]:
+        if histogram['metric'] == 'medvault_script_run_seconds':
+            return histogram['sum_s']
+    return 0.0
+
+
+def _sample(reruns):
+    sys.path.insert(0, REPO_ROOT)
+    from streamlit.testing.v1 import AppTest
+
+    import metrics
+
+    work_dir = tempfile.mkdtemp(prefix='medvault-startup-')
+    os.chdir(work_dir)
+    try:
+        preloaded = {name for name in HEAVY_MODULES if name in sys.modules}
+        app = AppTest.from_file(os.path.join(REPO_ROOT, 'app.py'), default_timeout=60)
+        start = time.perf_counter()
+        app.run()
+        cold_start = time.perf_counter() - start
+        if app.exception:
+            raise RuntimeError(app.exception[0].message)
+        loaded = sorted(name for name in HEAVY_MODULES if name in sys.modules and name not in preloaded)
+        samples = []
+        for _ in range(reruns):
+            before = _script_seconds(metrics.REGISTRY)
+            app.run()
+            samples.append(_script_seconds(metrics.REGISTRY) - before)
+        return cold_start, samples, loaded
+    finally:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+def summarize(samples):
+    samples = sorted(samples)
+
+    def pct(p):
+        return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+    return {'n': len(samples), 'p50_ms': _ms(pct(50)), 'p95_ms': _ms(pct(95)), 'max_ms': _ms(samples[-1])}
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark MedVault cold start and per-rerun overhead.")
+    parser.add_argument('--samples', type=int, default=5, help="fresh processes to start")
+    parser.add_argument('--reruns', type=int, default=50, help="login page reruns timed per process")
+    parser.add_argument('--output', help="write results as JSON to this path")
+    args = parser.parse_args(argv)
+
+    context = multiprocessing.get_context('spawn')
+    cold_starts, reruns, loaded = [], [], set()
+    for _ in range(args.samples):
+        with context.Pool(1) as pool:
+            cold_start, samples, modules = pool.apply(_sample, (args.reruns,))
+        cold_starts.append(cold_start)
+        reruns += samples
+        loaded.update(modules)
+
+    results = {
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'config': vars(args),
+        'cold_start': summarize(cold_starts),
+        'rerun': summarize(reruns),
+        'heavy_modules_loaded': sorted(loaded),
+    }
+    print(f"cold start  p50 {results['cold_start']['p50_ms']:>9.2f} ms   p95 {results['cold_start']['p95_ms']:>9.2f} ms   (n={args.samples})")
+    print(f"rerun       p50 {results['rerun']['p50_ms']:>9.2f} ms   p95 {results['rerun']['p95_ms']:>9.2f} ms   (n={len(reruns)})")
+    print(f"heavy modules loaded by the login page: {', '.join(results['heavy_modules_loaded']) or 'none'}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Bulk patient import and export for onboarding whole clinics at once.
+
+    python bulk.py import clinic.csv --rejects rejects.csv --credentials credentials.csv
+    python bulk.py export patients_export.csv
+
+The input is read in chunks and validated with vectorized pandas checks.
+Accepted rows get one contiguous block of patient IDs and are written to the
+registry in a single batched commit. Export streams the registry row by row
+and leaves PINs out unless asked for.
+"""
+import argparse
+import csv
+import datetime
+import os
+import secrets
+import sys
+
+import pandas as pd
+
+from drugs import DrugIndex
+from medications import MedicationIndex
+from storage import (PATIENT_COLUMNS, STORAGE_BACKENDS, PatientIdSequence, format_patient_id,
+                     max_patient_number, open_patient_store)
+
+BLOOD_GROUPS = ["A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-"]
+MIN_DOB = pd.Timestamp(1920, 1, 1)
+IMPORT_COLUMNS = ['name', 'dob', 'blood_group', 'current_medications', 'medication_history', 'pin']
+DEFAULT_CHUNK_SIZE = 10_000
+
+
+def _normalize_medications(column):
+    """``"Crocin; Dolo"`` or one name per line -> one name per line, blanks dropped."""
+    return column.str.split(r'[;\n]').map(lambda names: '\n'.join(n.strip() for n in names if n.strip()))
+
+
+def validate_chunk(chunk, today=None):
+    """
+    Returns ``(accepted, rejected)`` frames for one chunk of input rows.
+    Rejected rows keep their original values plus a ``reject_reason`` column.
+    Patients without a valid four-digit PIN are given a random one.
+    """
+    today = pd.Timestamp(today or datetime.date.today())
+    chunk = chunk.reindex(columns=IMPORT_COLUMNS, fill_value='')
+    chunk = chunk.apply(lambda column: column.str.strip())
+    dob = pd.to_datetime(chunk['dob'], format='%Y-%m-%d', errors='coerce')
+    blood_group = chunk['blood_group'].str.upper().str.replace(' ', '', regex=False)
+
+    reason = pd.Series('', index=chunk.index)
+    reason = reason.mask(~blood_group.isin(BLOOD_GROUPS), 'invalid blood_group')
+    reason = reason.mask(dob.isna() | (dob < MIN_DOB) | (dob > today), 'invalid dob')
+    reason = reason.mask(chunk['name'] == '', 'missing name')
+    ok = reason == ''
+
+    rejected = chunk[~ok].assign(reject_reason=reason[~ok])
+    accepted = chunk[ok].assign(
+        dob=dob[ok].dt.strftime('%Y-%m-%d'),
+        blood_group=blood_group[ok],
+        current_medications=_normalize_medications(chunk.loc[ok, 'current_medications']),
+        medication_history=_normalize_medications(chunk.loc[ok, 'medication_history']),
+    )
+    needs_pin = ~accepted['pin'].str.fullmatch(r'\d{4}')
+    accepted.loc[needs_pin, 'pin'] = [str(secrets.randbelow(9000) + 1000) for _ in range(needs_pin.sum())]
+    return accepted, rejected
+
+
+def import_patients(store, sequence, input_path, chunk_size=DEFAULT_CHUNK_SIZE, rejects_path=None,
+                    credentials_path=None, medication_index=None):
+    """Returns ``(imported, rejected)`` counts."""
+    accepted, rejected_count = [], 0
+    rejects_file = open(rejects_path, 'w', newline='', encoding='utf-8') if rejects_path else None
+    try:
+        reader = pd.read_csv(input_path, chunksize=chunk_size, dtype=str, keep_default_na=False)
+        for chunk in reader:
+            valid, rejected = validate_chunk(chunk)
+            accepted.append(valid)
+            rejected_count += len(rejected)
+            if rejects_file and len(rejected):
+                rejected.to_csv(rejects_file, header=rejects_file.tell() == 0, index=False, lineterminator='\n')
+    finally:
+        if rejects_file:
+            rejects_file.close()
+
+    patients = pd.concat(accepted, ignore_index=True) if accepted else pd.DataFrame(columns=IMPORT_COLUMNS)
+    if len(patients):
+        first = sequence.reserve(len(patients))
+        patients.insert(0, 'patient_id', [format_patient_id(n) for n in range(first, first + len(patients))])
+        records = store.add_patients(patients.reindex(columns=PATIENT_COLUMNS, fill_value='').to_dict('records'))
+        if medication_index is not None:
+            medication_index.update_patients(records)
+        if credentials_path:
+            patients[['patient_id', 'name', 'pin']].to_csv(credentials_path, index=False, lineterminator='\n')
+    return len(patients), rejected_count
+
+
+def export_patients(store, output, include_pins=False):
+    """Streams every patient record to ``output`` (a path, or ``-`` for stdout). Returns the row count."""
+    columns = [col for col in PATIENT_COLUMNS if include_pins or col != 'pin']
+    f = sys.stdout if output == '-' else open(output, 'w', newline='', encoding='utf-8')
+    try:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        count = 0
+        for record in store.iter_records():
+            writer.writerow(record)
+            count += 1
+    finally:
+        if f is not sys.stdout:
+            f.close()
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk patient import and export.")
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--backend', choices=STORAGE_BACKENDS,
+                        default=os.environ.get('MEDVAULT_STORAGE_BACKEND', 'csv'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help="Add patients from a CSV file.")
+    import_parser.add_argument('input', help=f"CSV with columns {', '.join(IMPORT_COLUMNS)} (pin optional)")
+    import_parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    import_parser.add_argument('--rejects', help="write rejected rows and the reason to this CSV")
+    import_parser.add_argument('--credentials', help="write the assigned patient IDs and PINs to this CSV")
+
+    export_parser = subparsers.add_parser('export', help="Write every patient to a CSV file.")
+    export_parser.add_argument('output', help="output path, or - for stdout")
+    export_parser.add_argument('--include-pins', action='store_true')
+    args = parser.parse_args(argv)
+
+    store = open_patient_store(args.backend, args.data_dir)
+    if args.command == 'import':
+        uploads_dir = os.path.join(args.data_dir, 'uploads')
+        sequence = PatientIdSequence(os.path.join(args.data_dir, 'patient_id.seq'),
+                                     seed=lambda: max_patient_number(store, uploads_dir))
+        medication_index = MedicationIndex(os.path.join(args.data_dir, 'medications.db'),
+                                           DrugIndex(os.path.join(args.data_dir, 'drug_map.csv')))
+        imported, rejected = import_patients(store, sequence, args.input, args.chunk_size,
+                                             args.rejects, args.credentials, medication_index)
+        print(f"Imported {imported} patients, rejected {rejected}.")
+        if rejected and args.rejects:
+            print(f"Rejected rows written to {args.rejects}.")
+        if imported and not args.credentials:
+            print("No --credentials file given: the generated PINs were not saved anywhere.")
+    else:
+        count = export_patients(store, args.output, args.include_pins)
+        if args.output != '-':
+            print(f"Exported {count} patients to {args.output}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+import bisect
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from storage import file_signature, thread_local_connection
+
+OPENFDA_LABEL_URL = "https://api.fda.gov/drug/label.json"
+
+# A label younger than LABEL_TTL is served as-is. Up to LABEL_STALE_TTL it is
+# still served, but refreshed in the background.
+LABEL_TTL = 24 * 3600
+LABEL_STALE_TTL = 30 * 24 * 3600
+LABEL_CACHE_MAX_ENTRIES = 5000
+# A cache hit only rewrites the entry's last_access (for LRU eviction) once
+# it is older than this, so steady reads do not turn into a write each.
+LABEL_ACCESS_RESOLUTION = 3600
+
+# After a failed request (timeout, connection error, 5xx) the name is not
+# retried for this many seconds; lookups answer from the cache or fail fast.
+FAILURE_BACKOFF = 60
+
+# Upper bound on simultaneous openFDA requests from one process.
+MAX_CONCURRENT_LOOKUPS = 8
+
+# Fuzzy matches sharing fewer trigrams than this (Jaccard) are dropped.
+FUZZY_MIN_SIMILARITY = 0.2
+
+CONNECTION_ERROR = "Could not connect to the server. Please check your internet connection."
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class DrugIndex:
+    """
+    Search index over drug_map.csv (Indian brand name -> US name): a dict for
+    exact resolution, a sorted name array for prefix search and a trigram
+    inverted index for typo-tolerant matches. Rebuilt only when the CSV's
+    mtime or size changes.
+    """
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self._lock = threading.Lock()
+        self._signature = None
+        self._us_names = {}
+        self._names = []
+        self._trigrams = {}
+
+    def _build(self):
+        us_names = {}
+        if os.path.exists(self.csv_path):
+            with open(self.csv_path, newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    name = (row.get('indian_name') or '').strip().lower()
+                    if name:
+                        us_names.setdefault(name, (row.get('us_name') or '').strip() or name)
+        trigrams = {}
+        for name in us_names:
+            for gram in _trigrams(name):
+                trigrams.setdefault(gram, []).append(name)
+        self._us_names, self._names, self._trigrams = us_names, sorted(us_names), trigrams
+
+    def refresh(self):
+        signature = file_signature(self.csv_path)
+        if signature == self._signature:
+            return
+        with self._lock:
+            signature = file_signature(self.csv_path)
+            if signature != self._signature:
+                self._build()
+                self._signature = signature
+
+    def names(self):
+        self.refresh()
+        return list(self._names)
+
+    def resolve(self, drug_name):
+        """US name for an Indian brand name; unknown names are returned unchanged."""
+        self.refresh()
+        return self._us_names.get(drug_name.strip().lower(), drug_name)
+
+    def search(self, query, limit=10):
+        """Names starting with ``query``, then close fuzzy matches, best first."""
+        self.refresh()
+        query = query.strip().lower()
+        if not query:
+            return []
+        results = []
+        i = bisect.bisect_left(self._names, query)
+        while i < len(self._names) and len(results) < limit and self._names[i].startswith(query):
+            results.append(self._names[i])
+            i += 1
+        if len(results) < limit:
+            query_grams = _trigrams(query)
+            shared = {}
+            for gram in query_grams:
+                for name in self._trigrams.get(gram, ()):
+                    shared[name] = shared.get(name, 0) + 1
+            scored = []
+            for name, count in shared.items():
+                similarity = count / (len(query_grams) + len(name) + 1 - count)
+                if similarity >= FUZZY_MIN_SIMILARITY and name not in results:
+                    scored.append((-similarity, name))
+            results += [name for _, name in sorted(scored)[:limit - len(results)]]
+        return results
+
+
+class LabelCache:
+    """
+    openFDA label responses stored in SQLite, keyed by the US drug name the
+    query was made with. Every worker process opens the same file, so a
+    label fetched by one is reused by all of them and survives restarts.
+    Least recently used entries are evicted past ``max_entries``; access
+    times are tracked to within ``access_resolution`` seconds.
+    """
+
+    def __init__(self, db_path, max_entries=LABEL_CACHE_MAX_ENTRIES, access_resolution=LABEL_ACCESS_RESOLUTION):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.access_resolution = access_resolution
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS labels ("
+                "us_name TEXT PRIMARY KEY, label TEXT, fetched_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS labels_last_access ON labels (last_access)")
+
+    def _connect(self):
+        return thread_local_connection(self._local, self.db_path)
+
+    def get(self, us_name):
+        """
+        Returns ``(label, fetched_at)`` or None on a miss. ``label`` is None
+        when openFDA had no result for the name (cached negative answer).
+        """
+        conn = self._connect()
+        row = conn.execute("SELECT label, fetched_at, last_access FROM labels WHERE us_name = ?",
+                           (us_name,)).fetchone()
+        if row is None:
+            return None
+        label, fetched_at, last_access = row
+        now = time.time()
+        if now - last_access >= self.access_resolution:
+            with conn:
+                conn.execute("UPDATE labels SET last_access = ? WHERE us_name = ?", (now, us_name))
+        return (json.loads(label) if label is not None else None), fetched_at
+
+    def put(self, us_name, label):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO labels (us_name, label, fetched_at, last_access) VALUES (?, ?, ?, ?)",
+                (us_name, json.dumps(label) if label is not None else None, now, now),
+            )
+            conn.execute(
+                "DELETE FROM labels WHERE us_name IN ("
+                "SELECT us_name FROM labels ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+
+def extract_label_info(label):
+    return {
+        "Purpose": label.get('purpose', ["Not available"])[0],
+        "Warnings": label.get('warnings', ["Not available"])[0],
+        "Active Ingredient": label.get('active_ingredient', ["Not available"])[0],
+    }
+
+
+class DrugInfoClient:
+    """
+    openFDA label lookups through a LabelCache with stale-while-revalidate.
+    In offline mode the API is never called and only cached labels are
+    served, however old. A name whose request failed is not retried until
+    ``failure_backoff`` seconds have passed, so an unreachable API costs one
+    timeout per name rather than one per rerun.
+    """
+
+    def __init__(self, cache, base_url=OPENFDA_LABEL_URL, offline=False, ttl=LABEL_TTL,
+                 stale_ttl=LABEL_STALE_TTL, timeout=10, max_concurrency=MAX_CONCURRENT_LOOKUPS,
+                 failure_backoff=FAILURE_BACKOFF):
+        # requests is only imported once a client is actually needed.
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.cache = cache
+        self.base_url = base_url
+        self.offline = offline
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.failure_backoff = failure_backoff
+        # One keep-alive connection pool for every lookup made by this client.
+        self.session = requests.Session()
+        self._request_error = requests.exceptions.RequestException
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='openfda')
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+        # us_name -> time.monotonic() before which it is not requested again.
+        self._failures = {}
+
+    def _backing_off(self, us_name):
+        retry_at = self._failures.get(us_name)
+        return retry_at is not None and time.monotonic() < retry_at
+
+    def _fetch_label(self, us_name):
+        """
+        Queries openFDA and caches the answer. Raises RequestException, after
+        starting the name's backoff.
+        """
+        try:
+            with metrics.time_block('medvault_openfda_request_seconds'):
+                response = self.session.get(
+                    self.base_url,
+                    params={'search': f'openfda.brand_name:"{us_name}"', 'limit': 1},
+                    timeout=self.timeout,
+                )
+            if response.status_code == 404:
+                # openFDA answers "no matches" with a 404.
+                label = None
+            else:
+                response.raise_for_status()
+                results = response.json().get('results')
+                label = results[0] if results else None
+        except self._request_error:
+            metrics.inc('medvault_openfda_failures_total')
+            self._failures[us_name] = time.monotonic() + self.failure_backoff
+            raise
+        self._failures.pop(us_name, None)
+        self.cache.put(us_name, label)
+        return label
+
+    def _refresh_in_background(self, us_name):
+        with self._refreshing_lock:
+            if us_name in self._refreshing or self._backing_off(us_name):
+                return
+            self._refreshing.add(us_name)
+
+        def refresh():
+            try:
+                self._fetch_label(us_name)
+            except self._request_error:
+                pass
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(us_name)
+
+        self._executor.submit(refresh)
+
+    def get_label(self, us_name):
+        """
+        Returns ``(found, label)``; ``found`` is False when the lookup could
+        not be answered at all (network failure or offline cache miss).
+        """
+        key = us_name.lower()
+        cached = self.cache.get(key)
+        if cached is not None:
+            label, fetched_at = cached
+            age = time.time() - fetched_at
+            if self.offline or age < self.ttl:
+                metrics.inc('medvault_label_cache_requests_total', result='hit')
+                return True, label
+            if age < self.stale_ttl:
+                metrics.inc('medvault_label_cache_requests_total', result='stale')
+                self._refresh_in_background(key)
+                return True, label
+        if self._backing_off(key):
+            metrics.inc('medvault_label_cache_requests_total', result='backoff')
+            return (True, cached[0]) if cached is not None else (False, None)
+        metrics.inc('medvault_label_cache_requests_total', result='miss')
+        if self.offline:
+            return False, None
+        try:
+            return True, self._fetch_label(key)
+        except self._request_error:
+            if cached is not None:
+                return True, cached[0]
+            return False, None
+
+    def lookup(self, us_name, display_name=None):
+        """Returns the Purpose / Warnings / Active Ingredient dict, or an ``Error`` entry."""
+        return self._format(self.get_label(us_name), display_name or us_name)
+
+    def lookup_many(self, us_names):
+        """
+        Batch form of ``lookup``. ``us_names`` maps each display name to its
+        resolved US name; names sharing a US name are fetched once, and the
+        distinct fetches run concurrently over the pooled session.
+        """
+        unique = list({us_name.lower() for us_name in us_names.values()})
+        labels = dict(zip(unique, self._executor.map(self.get_label, unique)))
+        return {display_name: self._format(labels[us_name.lower()], display_name)
+                for display_name, us_name in us_names.items()}
+
+    def _format(self, result, display_name):
+        found, label = result
+        if not found:
+            if self.offline:
+                return {"Error": f"Offline mode: no saved information for '{display_name}'."}
+            return {"Error": CONNECTION_ERROR}
+        if label is None:
+            return {"Error": f"No information found for '{display_name}'."}
+        return extract_label_info(label)
@@ -0,0 +1,148 @@
+"""
+Drug interaction and duplication screening.
+
+Rules come from a local CSV (``ingredient_a, ingredient_b, severity,
+message``) over canonical ingredient names, i.e. the US generic names from
+drug_map.csv. A rule naming the same ingredient twice flags duplication,
+such as Crocin + Dolo (both acetaminophen). The rules are compiled into a
+symmetric ingredient-pair matrix, so checking a pair is one array lookup,
+and a sweep over the whole registry is a handful of vectorized operations.
+
+    python interactions.py sweep --data-dir data --output findings.csv
+"""
+import argparse
+import csv
+import os
+import threading
+
+import metrics
+from drugs import DrugIndex
+from medications import MedicationIndex
+from storage import STORAGE_BACKENDS, file_signature, open_patient_store
+
+SEVERITIES = ('low', 'moderate', 'high')
+FINDING_COLUMNS = ['patient_id', 'drug_a', 'drug_b', 'severity', 'message']
+
+
+class InteractionChecker:
+    """
+    Ingredient-pair rule matrix built from the rules CSV. Rebuilt only when
+    the file's mtime or size changes.
+    """
+
+    def __init__(self, rules_path):
+        self.rules_path = rules_path
+        self._lock = threading.Lock()
+        self._signature = None
+        self._codes = {}
+        # _matrix[a, b] is 1 + the rule's position in _rules, 0 when no rule applies.
+        self._matrix = None
+        self._rules = []
+
+    def _build(self):
+        import numpy as np
+        rules, codes = [], {}
+        if os.path.exists(self.rules_path):
+            with open(self.rules_path, newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    a = (row.get('ingredient_a') or '').strip().lower()
+                    b = (row.get('ingredient_b') or '').strip().lower()
+                    severity = (row.get('severity') or '').strip().lower()
+                    if a and b and severity in SEVERITIES:
+                        rules.append((a, b, severity, (row.get('message') or '').strip()))
+                        codes.setdefault(a, len(codes))
+                        codes.setdefault(b, len(codes))
+        matrix = np.zeros((len(codes), len(codes)), dtype=np.int32)
+        for position, (a, b, _, _) in enumerate(rules, start=1):
+            matrix[codes[a], codes[b]] = matrix[codes[b], codes[a]] = position
+        self._codes, self._matrix, self._rules = codes, matrix, rules
+
+    def refresh(self):
+        signature = file_signature(self.rules_path)
+        if signature == self._signature:
+            return
+        with self._lock:
+            signature = file_signature(self.rules_path)
+            if signature != self._signature:
+                self._build()
+                self._signature = signature
+
+    def check(self, medications):
+        """
+        Screens one patient's medications, given as ``[(name, canonical), ...]``.
+        Returns a list of finding dicts (drug_a, drug_b, severity, message),
+        most severe first.
+        """
+        self.refresh()
+        coded = [(name, self._codes[canonical]) for name, canonical in medications if canonical in self._codes]
+        findings = []
+        for i, (name_a, code_a) in enumerate(coded):
+            for name_b, code_b in coded[i + 1:]:
+                position = self._matrix[code_a, code_b]
+                if position:
+                    _, _, severity, message = self._rules[position - 1]
+                    findings.append({'drug_a': name_a, 'drug_b': name_b, 'severity': severity, 'message': message})
+        return sorted(findings, key=lambda f: -SEVERITIES.index(f['severity']))
+
+    def sweep(self, medications):
+        """
+        Screens every patient at once. ``medications`` is a DataFrame with
+        one row per medication (``patient_id``, ``name``, ``canonical``).
+        Returns a DataFrame with FINDING_COLUMNS, one row per flagged pair.
+        """
+        import numpy as np
+        import pandas as pd
+        self.refresh()
+        with metrics.time_block('medvault_interaction_sweep_seconds'):
+            codes = medications['canonical'].map(self._codes)
+            known = medications.loc[codes.notna(), ['patient_id', 'name']].assign(code=codes.dropna().astype(np.int64))
+            known = known.reset_index(drop=True).rename_axis('row').reset_index()
+            pairs = known.merge(known, on='patient_id', suffixes=('_a', '_b'))
+            pairs = pairs[pairs['row_a'] < pairs['row_b']]
+            positions = self._matrix[pairs['code_a'].to_numpy(), pairs['code_b'].to_numpy()]
+            pairs = pairs[positions > 0]
+            rules = pd.DataFrame(self._rules, columns=['ingredient_a', 'ingredient_b', 'severity', 'message'])
+            matched = rules.iloc[positions[positions > 0] - 1]
+            findings = pd.DataFrame({
+                'patient_id': pairs['patient_id'].to_numpy(),
+                'drug_a': pairs['name_a'].to_numpy(),
+                'drug_b': pairs['name_b'].to_numpy(),
+                'severity': matched['severity'].to_numpy(),
+                'message': matched['message'].to_numpy(),
+            }, columns=FINDING_COLUMNS)
+        metrics.inc('medvault_interaction_findings_total', len(findings))
+        return findings
+
+
+def current_medications_frame(medication_index):
+    """Everyone's current medications from the MedicationIndex table, ready for ``sweep``."""
+    import pandas as pd
+    return pd.DataFrame(medication_index.entries('current'), columns=['patient_id', 'name', 'canonical'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drug interaction screening.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sweep_parser = subparsers.add_parser('sweep', help="Screen every patient's current medications.")
+    sweep_parser.add_argument('--data-dir', default='data')
+    sweep_parser.add_argument('--backend', choices=STORAGE_BACKENDS,
+                              default=os.environ.get('MEDVAULT_STORAGE_BACKEND', 'csv'))
+    sweep_parser.add_argument('--rules', help="rules CSV (default: <data-dir>/interaction_rules.csv)")
+    sweep_parser.add_argument('--output', help="write findings to this CSV")
+    args = parser.parse_args(argv)
+
+    medication_index = MedicationIndex(os.path.join(args.data_dir, 'medications.db'),
+                                       DrugIndex(os.path.join(args.data_dir, 'drug_map.csv')))
+    medication_index.sync(open_patient_store(args.backend, args.data_dir))
+    checker = InteractionChecker(args.rules or os.path.join(args.data_dir, 'interaction_rules.csv'))
+    findings = checker.sweep(current_medications_frame(medication_index))
+    print(f"{len(findings)} findings across {findings['patient_id'].nunique()} patients.")
+    for severity, count in findings['severity'].value_counts().items():
+        print(f"  {severity}: {count}")
+    if args.output:
+        findings.to_csv(args.output, index=False, lineterminator='\n')
+        print(f"Wrote {args.output}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import threading
+
+import metrics
+from storage import file_signature, thread_local_connection
+
+# Patient record column behind each medication list.
+MEDICATION_LISTS = {'current': 'current_medications', 'history': 'medication_history'}
+
+
+def split_medications(text):
+    """Newline-joined medication text -> list of names, blanks dropped."""
+    return [name.strip() for name in str(text or '').splitlines() if name.strip()]
+
+
+def source_hash(record):
+    """Fingerprint of a record's medication lists, stored with its indexed rows."""
+    text = '\0'.join(str(record.get(column) or '') for column in MEDICATION_LISTS.values())
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+class MedicationIndex:
+    """
+    Normalized copy of every patient's medication lists in SQLite: one row
+    per (patient, list, medication), with the name canonicalized through the
+    DrugIndex (brand name -> US generic name, lower case). The index on
+    ``(canonical, list)`` is the inverted drug -> patient index, so "who is
+    currently on ibuprofen" is an index range scan rather than a pass over
+    the registry.
+
+    The patient store stays the source of truth. Writers call
+    ``update_patients`` after saving records. Each indexed patient carries a
+    fingerprint of the medication text it was built from, so ``sync`` can
+    re-index exactly the patients whose record no longer matches (a crash
+    between the two writes, restores, edits made outside the app) and drop
+    the ones that are gone; ``ensure_patient`` does the same for one record.
+    When drug_map.csv changes, stored names are re-canonicalized on the next
+    query. Every worker process shares the same database file.
+    """
+
+    def __init__(self, db_path, drug_index):
+        self.db_path = db_path
+        self.drug_index = drug_index
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS indexed_patients (patient_id TEXT PRIMARY KEY, source_hash TEXT)")
+            if 'source_hash' not in {row[1] for row in conn.execute('PRAGMA table_info(indexed_patients)')}:
+                conn.execute("ALTER TABLE indexed_patients ADD COLUMN source_hash TEXT")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS patient_medications ("
+                "patient_id TEXT NOT NULL, list TEXT NOT NULL, position INTEGER NOT NULL, "
+                "name TEXT NOT NULL, canonical TEXT NOT NULL, PRIMARY KEY (patient_id, list, position))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS patient_medications_canonical "
+                         "ON patient_medications (canonical, list, patient_id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _connect(self):
+        return thread_local_connection(self._local, self.db_path)
+
+    def canonical(self, drug_name):
+        return self.drug_index.resolve(drug_name.strip()).strip().lower()
+
+    def _drug_map_signature(self):
+        return json.dumps(file_signature(self.drug_index.csv_path))
+
+    def _rows(self, records):
+        for record in records:
+            for list_name, column in MEDICATION_LISTS.items():
+                for position, name in enumerate(split_medications(record.get(column))):
+                    yield record['patient_id'], list_name, position, name, self.canonical(name)
+
+    def _write(self, conn, records):
+        conn.executemany("DELETE FROM patient_medications WHERE patient_id = ?",
+                         [(record['patient_id'],) for record in records])
+        conn.executemany("INSERT OR REPLACE INTO indexed_patients (patient_id, source_hash) VALUES (?, ?)",
+                         [(record['patient_id'], source_hash(record)) for record in records])
+        conn.executemany("INSERT INTO patient_medications (patient_id, list, position, name, canonical) "
+                         "VALUES (?, ?, ?, ?, ?)", self._rows(records))
+
+    def update_patients(self, records):
+        """Replaces the indexed medications of each record's patient in one transaction."""
+        records = list(records)
+        with metrics.time_block('medvault_medication_index_update_seconds'), self._connect() as conn:
+            self._write(conn, records)
+
+    def update_patient(self, record):
+        self.update_patients([record])
+
+    def rebuild(self, records):
+        with metrics.time_block('medvault_medication_index_rebuild_seconds'), self._connect() as conn:
+            conn.execute("DELETE FROM patient_medications")
+            conn.execute("DELETE FROM indexed_patients")
+            self._write(conn, list(records))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('drug_map_signature', ?)",
+                         (self._drug_map_signature(),))
+
+    def sync(self, store):
+        """
+        Brings the table in line with ``store``: re-indexes patients whose
+        medication text changed since they were indexed and removes patients
+        the store no longer has. Builds from scratch when the table is empty.
+        Returns how many patients were re-indexed or removed.
+        """
+        conn = self._connect()
+        indexed = dict(conn.execute("SELECT patient_id, source_hash FROM indexed_patients"))
+        if not indexed:
+            records = list(store.iter_records())
+            self.rebuild(records)
+            return len(records)
+        with metrics.time_block('medvault_medication_index_sync_seconds'):
+            changed = [record for record in store.iter_records()
+                       if indexed.pop(record['patient_id'], None) != source_hash(record)]
+            removed = [(patient_id,) for patient_id in indexed]
+            if changed or removed:
+                with conn:
+                    conn.executemany("DELETE FROM patient_medications WHERE patient_id = ?", removed)
+                    conn.executemany("DELETE FROM indexed_patients WHERE patient_id = ?", removed)
+                    self._write(conn, changed)
+        metrics.inc('medvault_medication_index_resynced_total', len(changed) + len(removed))
+        return len(changed) + len(removed)
+
+    def ensure_patient(self, record):
+        """Re-indexes one patient if the index was built from different medication text. Returns True if it did."""
+        row = self._connect().execute("SELECT source_hash FROM indexed_patients WHERE patient_id = ?",
+                                      (record['patient_id'],)).fetchone()
+        if row is not None and row[0] == source_hash(record):
+            return False
+        self.update_patient(record)
+        metrics.inc('medvault_medication_index_resynced_total')
+        return True
+
+    def _recanonicalize_if_needed(self):
+        signature = self._drug_map_signature()
+        conn = self._connect()
+        row = conn.execute("SELECT value FROM meta WHERE key = 'drug_map_signature'").fetchone()
+        if row and row[0] == signature:
+            return
+        with self._lock, conn:
+            conn.create_function('canonical', 1, self.canonical, deterministic=True)
+            conn.execute("UPDATE patient_medications SET canonical = canonical(name) WHERE canonical != canonical(name)")
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('drug_map_signature', ?)", (signature,))
+
+    def patients_on(self, drug_name, lists=tuple(MEDICATION_LISTS)):
+        """Sorted IDs of patients with ``drug_name`` (or any brand of it) in the given lists."""
+        self._recanonicalize_if_needed()
+        placeholders = ', '.join('?' for _ in lists)
+        with metrics.time_block('medvault_medication_query_seconds'):
+            rows = self._connect().execute(
+                f"SELECT DISTINCT patient_id FROM patient_medications WHERE canonical = ? AND list IN ({placeholders}) "
+                "ORDER BY patient_id", [self.canonical(drug_name), *lists]).fetchall()
+        return [patient_id for (patient_id,) in rows]
+
+    def medications(self, patient_id):
+        """Returns ``{list: [(name, canonical), ...]}`` for one patient, in entry order."""
+        self._recanonicalize_if_needed()
+        result = {list_name: [] for list_name in MEDICATION_LISTS}
+        for list_name, name, canonical in self._connect().execute(
+                "SELECT list, name, canonical FROM patient_medications WHERE patient_id = ? ORDER BY list, position",
+                (patient_id,)):
+            result[list_name].append((name, canonical))
+        return result
+
+    def entries(self, list_name='current'):
+        """Every row of one list as ``[(patient_id, name, canonical), ...]``, for batch jobs."""
+        self._recanonicalize_if_needed()
+        return self._connect().execute(
+            "SELECT patient_id, name, canonical FROM patient_medications WHERE list = ?", (list_name,)).fetchall()
+
+    def drug_counts(self, list_name='current', limit=20):
+        """Most common canonical drugs in one list as ``[(canonical, patients), ...]``."""
+        self._recanonicalize_if_needed()
+        return self._connect().execute(
+            "SELECT canonical, COUNT(DISTINCT patient_id) AS patients FROM patient_medications WHERE list = ? "
+            "GROUP BY canonical ORDER BY patients DESC, canonical LIMIT ?", (list_name, limit)).fetchall()
@@ -0,0 +1,188 @@
+import bisect
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Histogram bucket upper bounds, in seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Per-process text files, as named by ``textfile_name``.
+_TEXTFILE_RE = re.compile(r'^(?P<prefix>.+)-(?P<pid>\d+)\.prom$')
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (f'{k}="{_escape(v)}"' for k, v in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and latency histograms, rendered in the Prometheus
+    text exposition format. Every metric name may carry labels.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._last_write = 0.0
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, **labels):
+        """Decorator form of ``time``."""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.time(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """Returns ``(counters, histograms)`` as lists of plain dicts for display."""
+        with self._lock:
+            counters = [{'metric': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{'metric': name, 'labels': dict(labels), 'count': h['count'], 'sum_s': h['sum'],
+                           'mean_ms': h['sum'] / h['count'] * 1000 if h['count'] else 0.0}
+                          for (name, labels), h in sorted(self._histograms.items())]
+        return counters, histograms
+
+    def render_prometheus(self, **const_labels):
+        """
+        The registry in text exposition format. ``const_labels`` (e.g. the
+        process ID) are added to every series, so several processes' output
+        can be scraped side by side.
+        """
+        const_key = _label_key(const_labels)
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in seen:
+                    lines.append(f'# TYPE {name} counter')
+                    seen.add(name)
+                lines.append(f'{name}{_format_labels(const_key + labels)} {value}')
+            for (name, labels), h in sorted(self._histograms.items()):
+                labels = const_key + labels
+                if name not in seen:
+                    lines.append(f'# TYPE {name} histogram')
+                    seen.add(name)
+                cumulative = 0
+                for bound, count in zip(self.buckets, h['buckets']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", repr(bound))])} {cumulative}')
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {h["count"]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {h["sum"]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {h["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path, min_interval=0.0, **const_labels):
+        """
+        Atomically writes the Prometheus text to ``path`` (e.g. for the
+        node_exporter textfile collector), at most once per ``min_interval``
+        seconds. ``const_labels`` are passed to ``render_prometheus``.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_write < min_interval:
+                return False
+            self._last_write = now
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render_prometheus(**const_labels))
+        os.replace(tmp_path, path)
+        return True
+
+
+def textfile_name(prefix, pid=None):
+    """``<prefix>-<pid>.prom``, one text file per process."""
+    return f'{prefix}-{os.getpid() if pid is None else pid}.prom'
+
+
+def remove_textfile(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _pid_alive(pid):
+    if os.name != 'posix':
+        # os.kill cannot probe a process on Windows without terminating it.
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_stale_textfiles(directory, prefix):
+    """
+    Deletes ``<prefix>-<pid>.prom`` files in ``directory`` whose process is
+    gone (e.g. killed before it could clean up). Returns how many.
+    """
+    removed = 0
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        match = _TEXTFILE_RE.match(name)
+        if match and match['prefix'] == prefix and not _pid_alive(int(match['pid'])):
+            remove_textfile(os.path.join(directory, name))
+            removed += 1
+    return removed
+
+
+REGISTRY = MetricsRegistry()
+
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+timed = REGISTRY.timed
+time_block = REGISTRY.time
@@ -0,0 +1,270 @@
+import hashlib
+import json
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from storage import FileLock, file_signature
+
+PROFILE_PIC_NAMES = ('profile_pic.png', 'profile_pic.jpg', 'profile_pic.jpeg')
+
+# Bytes read per chunk when streaming an upload into the blob store.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Patients whose manifest is kept in memory, least recently used dropped first.
+MANIFEST_CACHE_MAX_PATIENTS = 1024
+
+
+def safe_file_name(name):
+    """Strips any directory part from a client-supplied file name."""
+    name = os.path.basename(name.replace('\\', '/')).strip()
+    if name in ('', '.', '..'):
+        raise ValueError("Invalid file name.")
+    return name
+
+
+def _unique_name(name, taken):
+    """``report.pdf`` -> ``report (1).pdf`` etc. until it is not in ``taken``."""
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in taken:
+        candidate = f"{stem} ({n}){ext}"
+        n += 1
+    return candidate
+
+
+class BlobStore:
+    """
+    Content-addressed file store: each blob lives at ``<sha256[:2]>/<sha256>``
+    under ``blobs_dir``, so identical uploads are stored once however many
+    patients (or times) they are uploaded.
+    """
+
+    def __init__(self, blobs_dir):
+        self.blobs_dir = blobs_dir
+
+    def path(self, digest):
+        return os.path.join(self.blobs_dir, digest[:2], digest)
+
+    def put(self, fileobj):
+        """
+        Stores ``fileobj`` and returns ``(sha256, size)``. A seekable upload
+        (such as Streamlit's in-memory UploadedFile) is hashed first and only
+        written when its content is not stored yet; other streams are hashed
+        while they are copied to disk.
+        """
+        if getattr(fileobj, 'seekable', lambda: False)():
+            start = fileobj.tell()
+            digest, size = self._hash(fileobj)
+            if os.path.exists(self.path(digest)):
+                metrics.inc('medvault_blob_puts_total', result='duplicate')
+                return digest, size
+            fileobj.seek(start)
+        return self._write(fileobj)
+
+    @staticmethod
+    def _hash(fileobj):
+        digest = hashlib.sha256()
+        size = 0
+        while True:
+            chunk = fileobj.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+        return digest.hexdigest(), size
+
+    def _write(self, fileobj):
+        """Streams ``fileobj`` to disk in chunks while hashing it."""
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(prefix='.upload-', dir=self.blobs_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = fileobj.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            blob_path = self.path(digest.hexdigest())
+            if os.path.exists(blob_path):
+                os.remove(tmp_path)
+                metrics.inc('medvault_blob_puts_total', result='duplicate')
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, blob_path)
+                metrics.inc('medvault_blob_puts_total', result='stored')
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest.hexdigest(), size
+
+
+class ReportStore:
+    """
+    Report listings for each patient.
+
+    Every patient has a manifest (name, size, mtime, MIME type and, for
+    reports in the blob store, the content hash) kept as JSON under
+    ``manifest_dir``. Uploads go to the BlobStore and only add a reference
+    to the manifest. Files that sit directly in the patient's folder under
+    ``uploads_dir`` (from before the blob store existed) are listed too; the
+    folder is rescanned only when its mtime shows it changed. Rendering a
+    listing never touches the report files, and bytes are only read when a
+    download is actually requested. Parsed manifests are kept for the
+    ``max_patients`` most recently listed patients.
+    """
+
+    def __init__(self, uploads_dir, manifest_dir, blob_store, max_patients=MANIFEST_CACHE_MAX_PATIENTS):
+        self.uploads_dir = uploads_dir
+        self.manifest_dir = manifest_dir
+        self.blob_store = blob_store
+        self.max_patients = max_patients
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def _folder(self, patient_id):
+        return os.path.join(self.uploads_dir, safe_file_name(patient_id))
+
+    def _manifest_path(self, patient_id):
+        return os.path.join(self.manifest_dir, f'{safe_file_name(patient_id)}.json')
+
+    def _scan(self, folder):
+        entries = []
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.lower() not in PROFILE_PIC_NAMES and not entry.name.startswith('.'):
+                        stat = entry.stat()
+                        entries.append(self._entry(entry.name, stat.st_size, stat.st_mtime))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    @staticmethod
+    def _entry(name, size, mtime, sha256=None):
+        entry = {
+            'name': name,
+            'size': size,
+            'mtime': mtime,
+            'type': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+        }
+        if sha256:
+            entry['sha256'] = sha256
+        return entry
+
+    def _folder_signature(self, folder):
+        signature = file_signature(folder)[0]
+        return list(signature) if signature else None
+
+    def _read_manifest(self, patient_id):
+        try:
+            with open(self._manifest_path(patient_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_manifest(self, patient_id, folder_signature, entries):
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        path = self._manifest_path(patient_id)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'folder_signature': folder_signature, 'reports': entries}, f)
+        os.replace(tmp_path, path)
+
+    def _current_entries(self, patient_id, folder):
+        """
+        Returns ``(entries, up_to_date)``. When the folder changed since the
+        manifest was written, its files are rescanned and merged with the
+        blob references.
+        """
+        folder_signature = self._folder_signature(folder)
+        stored = self._read_manifest(patient_id)
+        entries = stored.get('reports', [])
+        if stored and stored.get('folder_signature') == folder_signature:
+            return entries, True
+        blob_refs = [e for e in entries if 'sha256' in e]
+        names = {e['name'] for e in blob_refs}
+        entries = blob_refs + [e for e in self._scan(folder) if e['name'] not in names]
+        return sorted(entries, key=lambda e: e['mtime'], reverse=True), False
+
+    @metrics.timed('medvault_report_listing_seconds')
+    def manifest(self, patient_id):
+        """Returns the patient's reports, newest first."""
+        folder = self._folder(patient_id)
+        manifest_path = self._manifest_path(patient_id)
+        signature = file_signature(folder, manifest_path)
+        with self._lock:
+            cached = self._cache.get(patient_id)
+            if cached and cached[0] == signature:
+                self._cache.move_to_end(patient_id)
+                metrics.inc('medvault_manifest_requests_total', result='hit')
+                return cached[1]
+
+        entries, up_to_date = self._current_entries(patient_id, folder)
+        metrics.inc('medvault_manifest_requests_total', result='disk' if up_to_date else 'rescan')
+        if not up_to_date:
+            os.makedirs(self.manifest_dir, exist_ok=True)
+            with FileLock(manifest_path + '.lock'):
+                entries, up_to_date = self._current_entries(patient_id, folder)
+                if not up_to_date:
+                    self._write_manifest(patient_id, self._folder_signature(folder), entries)
+            signature = file_signature(folder, manifest_path)
+        with self._lock:
+            self._cache[patient_id] = (signature, entries)
+            self._cache.move_to_end(patient_id)
+            while len(self._cache) > self.max_patients:
+                self._cache.popitem(last=False)
+        return entries
+
+    def page(self, patient_id, page, page_size):
+        """Returns ``(entries, page_count)`` for a 1-based page number."""
+        entries = self.manifest(patient_id)
+        page_count = max(1, -(-len(entries) // page_size))
+        page = min(max(page, 1), page_count)
+        return entries[(page - 1) * page_size:page * page_size], page_count
+
+    def save_report(self, patient_id, file_name, fileobj):
+        """
+        Streams ``fileobj`` into the blob store and adds it to the patient's
+        manifest. Re-uploading identical content under the same name is a
+        no-op; different content never overwrites an existing report, it is
+        saved under a numbered name instead. Returns the name used.
+        """
+        file_name = safe_file_name(file_name)
+        digest, size = self.blob_store.put(fileobj)
+        folder = self._folder(patient_id)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        with FileLock(self._manifest_path(patient_id) + '.lock'):
+            entries, _ = self._current_entries(patient_id, folder)
+            for entry in entries:
+                if entry['name'] == file_name and entry.get('sha256') == digest:
+                    return file_name
+            file_name = _unique_name(file_name, {e['name'] for e in entries})
+            entries.insert(0, self._entry(file_name, size, time.time(), digest))
+            self._write_manifest(patient_id, self._folder_signature(folder), entries)
+        return file_name
+
+    def report_path(self, patient_id, file_name):
+        for entry in self.manifest(patient_id):
+            if entry['name'] == file_name:
+                if 'sha256' in entry:
+                    return self.blob_store.path(entry['sha256'])
+                return os.path.join(self._folder(patient_id), safe_file_name(file_name))
+        raise FileNotFoundError(file_name)
+
+    def read_report(self, patient_id, file_name):
+        """Returns a report's bytes. Only called when a download is requested."""
+        with open(self.report_path(patient_id, file_name), 'rb') as f:
+            data = f.read()
+        metrics.inc('medvault_bytes_read_total', len(data), source='reports')
+        return data
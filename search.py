@@ -0,0 +1,268 @@
+import bisect
+import csv
+import importlib.util
+import io
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from reports import safe_file_name
+from storage import FileLock, file_signature
+
+# Extracted text kept per report, for matching and snippets.
+MAX_INDEXED_CHARS = 200_000
+SNIPPET_RADIUS = 80
+
+# Patients whose parsed index is kept in memory, least recently used dropped first.
+SEARCH_CACHE_MAX_PATIENTS = 256
+
+_TOKEN_RE = re.compile(r"[0-9a-z]+(?:\.[0-9]+)?")
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _extract_pdf(path):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return None
+    reader = PdfReader(path)
+    parts, size = [], 0
+    for page in reader.pages:
+        text = page.extract_text() or ''
+        parts.append(text)
+        size += len(text)
+        if size >= MAX_INDEXED_CHARS:
+            break
+    return '\n'.join(parts)
+
+
+def _extract_csv(path):
+    with open(path, encoding='utf-8', errors='replace', newline='') as f:
+        data = f.read(MAX_INDEXED_CHARS)
+    return '\n'.join(' '.join(cell.strip() for cell in row) for row in csv.reader(io.StringIO(data)))
+
+
+EXTRACTORS = {'.pdf': _extract_pdf, '.csv': _extract_csv}
+# Extensions whose extractor needs an optional package.
+EXTRACTOR_PACKAGES = {'.pdf': 'pypdf'}
+
+
+def can_extract(file_name):
+    """True if ``extract_text`` can read this file type with the packages installed."""
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext not in EXTRACTORS:
+        return False
+    package = EXTRACTOR_PACKAGES.get(ext)
+    return package is None or importlib.util.find_spec(package) is not None
+
+
+def extract_text(path, file_name):
+    """
+    Text of a PDF or CSV report, or None when the type is not supported
+    (images, or PDFs without pypdf installed).
+    """
+    extractor = EXTRACTORS.get(os.path.splitext(file_name)[1].lower())
+    if extractor is None:
+        return None
+    with metrics.time_block('medvault_report_extract_seconds', type=extractor.__name__[len('_extract_'):]):
+        text = extractor(path)
+    return None if text is None else text[:MAX_INDEXED_CHARS]
+
+
+def _snippet(text, terms):
+    lowered = text.lower()
+    hits = [i for i in (lowered.find(term) for term in terms) if i >= 0]
+    start = min(hits) if hits else 0
+    lo, hi = max(0, start - SNIPPET_RADIUS), min(len(text), start + SNIPPET_RADIUS)
+    snippet = ' '.join(text[lo:hi].split())
+    return ('…' if lo > 0 else '') + snippet + ('…' if hi < len(text) else '')
+
+
+class ReportSearchIndex:
+    """
+    Per-patient inverted index over extracted report text, one JSON file per
+    patient under ``index_dir``: ``docs`` maps each report name to its
+    version and text, ``postings`` maps each term to the reports containing
+    it. Documents are added under a cross-process lock, a batch at a time,
+    so indexing a patient's backlog rewrites the file once rather than once
+    per report. Queries read the cached index only;
+    report files are never opened at search time. Parsed indexes are kept
+    for the ``max_patients`` most recently searched patients.
+    """
+
+    def __init__(self, index_dir, max_patients=SEARCH_CACHE_MAX_PATIENTS):
+        self.index_dir = index_dir
+        self.max_patients = max_patients
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def _path(self, patient_id):
+        return os.path.join(self.index_dir, f'{safe_file_name(patient_id)}.json')
+
+    def _read(self, patient_id):
+        try:
+            with open(self._path(patient_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'docs': {}, 'postings': {}}
+
+    def _load(self, patient_id):
+        """Returns ``(index, sorted_terms)``, re-reading the file only when it changed."""
+        signature = file_signature(self._path(patient_id))
+        with self._lock:
+            cached = self._cache.get(patient_id)
+            if cached and cached[0] == signature:
+                self._cache.move_to_end(patient_id)
+                return cached[1], cached[2]
+        index = self._read(patient_id)
+        terms = sorted(index['postings'])
+        with self._lock:
+            self._cache[patient_id] = (signature, index, terms)
+            self._cache.move_to_end(patient_id)
+            while len(self._cache) > self.max_patients:
+                self._cache.popitem(last=False)
+        return index, terms
+
+    def documents(self, patient_id):
+        """``{name: {'version', 'status'}}`` for every report seen by the indexer."""
+        docs = self._load(patient_id)[0]['docs']
+        return {name: {'version': doc['version'], 'status': doc['status']} for name, doc in docs.items()}
+
+    def add_document(self, patient_id, name, version, text, status='indexed'):
+        """Adds or replaces one report. ``text`` is None for unsupported or unreadable files."""
+        self.add_documents(patient_id, [(name, version, text, status)])
+
+    def add_documents(self, patient_id, documents):
+        """Adds or replaces ``[(name, version, text, status), ...]`` in one write."""
+        os.makedirs(self.index_dir, exist_ok=True)
+        path = self._path(patient_id)
+        with FileLock(path + '.lock'):
+            index = self._read(patient_id)
+            postings = index['postings']
+            for name, version, text, status in documents:
+                old = index['docs'].get(name)
+                if old:
+                    for term in set(tokenize(old.get('text', ''))):
+                        names = postings.get(term, [])
+                        if name in names:
+                            names.remove(name)
+                        if not names:
+                            postings.pop(term, None)
+                for term in set(tokenize(text or '')):
+                    postings.setdefault(term, []).append(name)
+                index['docs'][name] = {'version': version, 'status': status, 'text': text or ''}
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, path)
+
+    def search(self, patient_id, query, limit=20):
+        """
+        Reports containing every query word (as a word prefix, so ``hemo``
+        finds ``hemoglobin``), as ``[{'name', 'snippet'}, ...]``.
+        """
+        query_terms = tokenize(query)
+        if not query_terms:
+            return []
+        with metrics.time_block('medvault_report_search_seconds'):
+            index, terms = self._load(patient_id)
+            matches, matched_terms = None, []
+            for query_term in query_terms:
+                names = set()
+                i = bisect.bisect_left(terms, query_term)
+                while i < len(terms) and terms[i].startswith(query_term):
+                    names.update(index['postings'][terms[i]])
+                    matched_terms.append(terms[i])
+                    i += 1
+                matches = names if matches is None else matches & names
+                if not matches:
+                    return []
+            results = [{'name': name, 'snippet': _snippet(index['docs'][name]['text'], matched_terms[:20])}
+                       for name in sorted(matches)[:limit]]
+        return results
+
+
+class ReportIndexer:
+    """
+    Extracts report text on a small background pool and feeds it to a
+    ReportSearchIndex, so uploads never wait for parsing. Each job covers
+    one patient's queued reports and writes the index once.
+    """
+
+    def __init__(self, report_store, search_index, max_workers=2):
+        self.report_store = report_store
+        self.search_index = search_index
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='report-index')
+        self._pending = set()
+        # Reports whose extraction failed and were already retried by this process.
+        self._retried = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _version(entry):
+        return entry.get('sha256') or f"{entry['size']}:{entry['mtime']}"
+
+    def _extract(self, patient_id, entry):
+        try:
+            text = extract_text(self.report_store.report_path(patient_id, entry['name']), entry['name'])
+            return text, 'indexed' if text is not None else 'unsupported'
+        except Exception:
+            metrics.inc('medvault_report_extract_failures_total')
+            return None, 'failed'
+
+    def _process(self, patient_id, entries):
+        try:
+            documents = [(entry['name'], self._version(entry), *self._extract(patient_id, entry)) for entry in entries]
+            self.search_index.add_documents(patient_id, documents)
+        finally:
+            with self._lock:
+                self._pending.difference_update((patient_id, entry['name']) for entry in entries)
+
+    def _submit(self, patient_id, entries):
+        """Queues the entries not already pending as one job. Returns ``(future, queued)``."""
+        with self._lock:
+            entries = [entry for entry in entries if (patient_id, entry['name']) not in self._pending]
+            if not entries:
+                return None, 0
+            self._pending.update((patient_id, entry['name']) for entry in entries)
+        return self._executor.submit(self._process, patient_id, entries), len(entries)
+
+    def submit(self, patient_id, file_name):
+        """Queues one saved report for indexing and returns its Future (None if already queued)."""
+        for entry in self.report_store.manifest(patient_id):
+            if entry['name'] == file_name:
+                return self._submit(patient_id, [entry])[0]
+        raise FileNotFoundError(file_name)
+
+    def _needs_indexing(self, patient_id, entry, doc):
+        if doc is None or doc['version'] != self._version(entry):
+            return True
+        if doc['status'] == 'unsupported':
+            # E.g. a PDF seen before pypdf was installed.
+            return can_extract(entry['name'])
+        if doc['status'] == 'failed' and (patient_id, entry['name']) not in self._retried:
+            self._retried.add((patient_id, entry['name']))
+            return can_extract(entry['name'])
+        return False
+
+    def backfill(self, patient_id):
+        """
+        Queues every report that is missing from the index, changed since,
+        or was skipped for lack of an extractor that is now available.
+        Failed extractions are retried once per process. Returns how many.
+        """
+        documents = self.search_index.documents(patient_id)
+        entries = [entry for entry in self.report_store.manifest(patient_id)
+                   if self._needs_indexing(patient_id, entry, documents.get(entry['name']))]
+        return self._submit(patient_id, entries)[1]
+
+    def pending(self, patient_id):
+        with self._lock:
+            return sum(1 for pid, _ in self._pending if pid == patient_id)
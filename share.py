@@ -0,0 +1,148 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+import metrics
+
+QR_CACHE_MAX_ENTRIES = 1024
+
+# Share links stay valid for SHARE_TOKEN_TTL after they are issued. Expiry
+# times are rounded up to SHARE_TOKEN_ROTATION, so a patient's link (and its
+# cached QR code) only changes once per rotation period.
+SHARE_TOKEN_TTL = 7 * 24 * 3600
+SHARE_TOKEN_ROTATION = 24 * 3600
+
+# Shorter signing keys are refused rather than used.
+MIN_SECRET_BYTES = 32
+
+
+def load_or_create_secret(path):
+    """
+    Returns the signing key stored at ``path``, creating a random one on
+    first use. Every worker process reads the same file. A new key is
+    written to a temp file and published with ``os.link``, so ``path`` only
+    ever appears complete; a worker that loses the race reads the winner's
+    key. Raises ValueError if the stored key is too short.
+    """
+    if not os.path.exists(path):
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.share-secret-', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(secrets.token_bytes(MIN_SECRET_BYTES))
+                f.flush()
+                os.fsync(f.fileno())
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path, 'rb') as f:
+        key = f.read()
+    if len(key) < MIN_SECRET_BYTES:
+        raise ValueError(f"Share signing key in {path} is shorter than {MIN_SECRET_BYTES} bytes; "
+                         "delete it to generate a new one.")
+    return key
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class ShareTokenSigner:
+    """
+    Issues and checks view-only share tokens of the form
+    ``<patient_id>.<generation>.<expires>.<signature>``, where the signature
+    is an HMAC-SHA256 over the other three fields. Checking a token needs no
+    storage access: the signature is compared in constant time and the
+    expiry against the clock. ``generation`` is the patient's share token
+    counter; bumping it (e.g. on a PIN change) revokes every earlier token,
+    which the caller checks against the patient record.
+    """
+
+    def __init__(self, secret, ttl=SHARE_TOKEN_TTL, rotation=SHARE_TOKEN_ROTATION):
+        if len(secret) < MIN_SECRET_BYTES:
+            raise ValueError(f"Share signing key must be at least {MIN_SECRET_BYTES} bytes.")
+        self.secret = secret
+        self.ttl = ttl
+        self.rotation = rotation
+
+    def _sign(self, payload):
+        return _b64(hmac.new(self.secret, payload.encode('utf-8'), hashlib.sha256).digest())
+
+    def issue(self, patient_id, generation, now=None):
+        now = time.time() if now is None else now
+        expires = (int(now) // self.rotation + 1) * self.rotation + self.ttl
+        payload = f"{patient_id}.{int(generation)}.{expires}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, token, now=None):
+        """Returns ``(patient_id, generation)`` for a valid, unexpired token, else None."""
+        parts = token.split('.') if token else []
+        if len(parts) != 4:
+            metrics.inc('medvault_share_token_checks_total', result='malformed')
+            return None
+        patient_id, generation, expires, signature = parts
+        if not hmac.compare_digest(signature.encode('ascii', 'replace'),
+                                   self._sign(f"{patient_id}.{generation}.{expires}").encode('ascii')):
+            metrics.inc('medvault_share_token_checks_total', result='bad_signature')
+            return None
+        if int(expires) < (time.time() if now is None else now):
+            metrics.inc('medvault_share_token_checks_total', result='expired')
+            return None
+        metrics.inc('medvault_share_token_checks_total', result='valid')
+        return patient_id, int(generation)
+
+
+@metrics.timed('medvault_qr_render_seconds')
+def render_qr_png(data):
+    import qrcode
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(data)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class QRCodeCache:
+    """
+    Rendered share QR codes as PNG bytes, one per patient, least recently
+    used first out. An entry is only reused while the patient's share URL
+    (which carries the token) is unchanged, so a new PIN or token gets a
+    fresh image.
+    """
+
+    def __init__(self, max_entries=QR_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, patient_id, url):
+        with self._lock:
+            cached = self._entries.get(patient_id)
+            if cached and cached[0] == url:
+                self._entries.move_to_end(patient_id)
+                metrics.inc('medvault_qr_cache_requests_total', result='hit')
+                return cached[1]
+        metrics.inc('medvault_qr_cache_requests_total', result='miss')
+        png = render_qr_png(url)
+        with self._lock:
+            self._entries[patient_id] = (url, png)
+            self._entries.move_to_end(patient_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return png
+
+    def invalidate(self, patient_id):
+        with self._lock:
+            self._entries.pop(patient_id, None)
@@ -0,0 +1,669 @@
+import argparse
+import csv
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+PATIENT_COLUMNS = ['patient_id', 'name', 'dob', 'blood_group', 'current_medications', 'medication_history', 'pin', 'avatar', 'share_generation']
+
+# Journal entries tolerated before the journal is folded back into the CSV.
+JOURNAL_COMPACT_THRESHOLD = 500
+
+STORAGE_BACKENDS = ('csv', 'sqlite', 'parquet')
+
+
+class FileLock:
+    """
+    Exclusive advisory lock on a sidecar ``.lock`` file, held across
+    processes (e.g. several Streamlit workers on one volume).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            else:
+                msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+        except BaseException:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+            self._thread_lock.release()
+
+
+def file_signature(*paths):
+    """(inode, mtime, size) per path; changes whenever a file is rewritten or appended to."""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            signature.append(None)
+            continue
+        signature.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def thread_local_connection(local, db_path, row_factory=None):
+    """
+    The calling thread's connection to ``db_path``, opened in WAL mode on
+    first use and kept on ``local`` (a ``threading.local``). sqlite3
+    connections cannot be shared between threads, and Streamlit serves each
+    session from its own thread.
+    """
+    conn = getattr(local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=30)
+        if row_factory is not None:
+            conn.row_factory = row_factory
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        local.conn = conn
+    return conn
+
+
+def _normalize_record(record):
+    return {col: str(record.get(col, '') or '') for col in PATIENT_COLUMNS}
+
+
+def _append_rows(path, rows):
+    """Appends CSV rows in a single write, adding the header to a new file."""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=PATIENT_COLUMNS, lineterminator='\n')
+    writer.writerows(rows)
+    with open(path, 'ab+') as f:
+        prefix = b''
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            prefix = (','.join(PATIENT_COLUMNS) + '\n').encode('utf-8')
+        else:
+            f.seek(size - 1)
+            if f.read(1) != b'\n':
+                prefix = b'\n'
+        f.write(prefix + buf.getvalue().encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class PatientStore:
+    """
+    Interface shared by the storage engines. Records are plain dicts with
+    the PATIENT_COLUMNS keys and string values.
+    """
+
+    def get(self, patient_id):
+        """Returns a copy of one patient record, or None."""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def records(self):
+        """Returns copies of every patient record."""
+        raise NotImplementedError
+
+    def ids(self):
+        raise NotImplementedError
+
+    def iter_records(self):
+        """Yields copies of every patient record, without building a full list where the engine allows."""
+        return iter(self.records())
+
+    def add_patient(self, record):
+        """Stores a new patient. Raises ValueError if the ID is taken."""
+        raise NotImplementedError
+
+    def add_patients(self, records):
+        """Stores many new patients in one write. Raises ValueError if any ID is taken."""
+        return [self.add_patient(record) for record in records]
+
+    def update_patient(self, patient_id, changes):
+        """Updates one patient's columns. Raises KeyError if it does not exist."""
+        raise NotImplementedError
+
+    def replace_all(self, records):
+        """Rewrites the whole registry (bulk edits and migrations only)."""
+        raise NotImplementedError
+
+
+class CsvPatientStore(PatientStore):
+    """
+    In-memory copy of patients.csv with a hash index on patient_id.
+
+    New patients are appended to the CSV and profile edits are appended to a
+    journal file as full rows (later rows win), so a write costs the same no
+    matter how many patients exist. Once the journal grows past
+    JOURNAL_COMPACT_THRESHOLD it is merged back into the CSV via an atomic
+    rename. All writes hold a cross-process lock.
+
+    Files are only re-read when their inode, mtime or size changes, so
+    lookups after the first load are a stat() call plus a dict hit. When
+    another process has only appended, just the new rows are read. Every
+    rewrite bumps a counter in an epoch file next to the CSV, so a rewritten
+    file is always reloaded in full, even if it reuses the old inode and has
+    grown past the old size.
+    """
+
+    def __init__(self, csv_path, journal_path=None, compact_threshold=JOURNAL_COMPACT_THRESHOLD):
+        self.csv_path = csv_path
+        self.journal_path = journal_path or os.path.splitext(csv_path)[0] + '_journal.csv'
+        self.epoch_path = os.path.splitext(csv_path)[0] + '.epoch'
+        self.compact_threshold = compact_threshold
+        self._file_lock = FileLock(csv_path + '.lock')
+        self._lock = threading.RLock()
+        self._records = {}
+        self._journal_entries = 0
+        self._signature = None
+        self._epoch = None
+        self._headers_current = False
+
+    def _file_signature(self):
+        return file_signature(self.csv_path, self.journal_path, self.epoch_path)
+
+    def _read_epoch(self):
+        try:
+            with open(self.epoch_path, encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _bump_epoch_locked(self):
+        epoch = self._read_epoch() + 1
+        tmp_path = f'{self.epoch_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(f'{epoch}\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.epoch_path)
+        return epoch
+
+    @staticmethod
+    def _read_rows(path, offset=0):
+        """Yields records from ``path``, starting at a row boundary ``offset`` past the header."""
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+            reader = csv.DictReader(text, fieldnames=PATIENT_COLUMNS if offset else None)
+            for row in reader:
+                record = {col: (row.get(col) or '') for col in PATIENT_COLUMNS}
+                if record['patient_id']:
+                    yield record
+
+    def _has_current_header(self, path):
+        try:
+            with open(path, newline='', encoding='utf-8') as f:
+                header = next(csv.reader(f), None)
+        except FileNotFoundError:
+            return True
+        return header is None or header == PATIENT_COLUMNS
+
+    def _migrate_header_locked(self):
+        """Rewrites files written before a column was added, so appended rows line up."""
+        if not (self._has_current_header(self.csv_path) and self._has_current_header(self.journal_path)):
+            self._compact_locked()
+
+    def _load(self):
+        records = {record['patient_id']: record for record in self._read_rows(self.csv_path)}
+        journal_entries = 0
+        for record in self._read_rows(self.journal_path):
+            records[record['patient_id']] = record
+            journal_entries += 1
+        return records, journal_entries
+
+    def _appended_only(self, signature):
+        """True if nothing was rewritten and every file kept its inode and only grew since the last load."""
+        if self._signature is None or not self._headers_current or self._read_epoch() != self._epoch:
+            return False
+        for old, new in zip(self._signature[:2], signature[:2]):
+            if old is None:
+                continue
+            if new is None or new[0] != old[0] or new[2] < old[2]:
+                return False
+        return True
+
+    def _refresh_locked(self):
+        signature = self._file_signature()
+        if signature == self._signature:
+            return
+        if self._appended_only(signature):
+            for path, old, new in zip((self.csv_path, self.journal_path), self._signature, signature):
+                offset = old[2] if old else 0
+                for record in self._read_rows(path, offset):
+                    self._records[record['patient_id']] = record
+                    if path == self.journal_path:
+                        self._journal_entries += 1
+                if new:
+                    metrics.inc('medvault_bytes_read_total', new[2] - offset, source='patients_csv')
+            metrics.inc('medvault_patient_store_reloads_total', kind='append')
+        else:
+            with metrics.time_block('medvault_patient_store_load_seconds'):
+                self._epoch = self._read_epoch()
+                self._records, self._journal_entries = self._load()
+            self._headers_current = self._has_current_header(self.csv_path) and self._has_current_header(self.journal_path)
+            metrics.inc('medvault_bytes_read_total', sum(part[2] for part in signature[:2] if part), source='patients_csv')
+            metrics.inc('medvault_patient_store_reloads_total', kind='full')
+        self._signature = signature
+
+    def refresh(self):
+        """Catches up with the CSV and journal if either changed since the last load."""
+        if self._file_signature() == self._signature:
+            return
+        # Holding the write lock guarantees no row is half-written while we read.
+        with self._lock, self._file_lock:
+            self._refresh_locked()
+
+    def get(self, patient_id):
+        self.refresh()
+        record = self._records.get(patient_id)
+        return dict(record) if record else None
+
+    def __len__(self):
+        self.refresh()
+        return len(self._records)
+
+    def records(self):
+        self.refresh()
+        return [dict(record) for record in self._records.values()]
+
+    def ids(self):
+        self.refresh()
+        return list(self._records)
+
+    def iter_records(self):
+        self.refresh()
+        for record in list(self._records.values()):
+            yield dict(record)
+
+    def add_patient(self, record):
+        return self.add_patients([record])[0]
+
+    def add_patients(self, records):
+        records = [_normalize_record(record) for record in records]
+        with self._lock, self._file_lock:
+            self._refresh_locked()
+            ids = [record['patient_id'] for record in records]
+            taken = [pid for pid in ids if pid in self._records]
+            if taken or len(set(ids)) != len(ids):
+                raise ValueError(f"Patient {(taken or ids)[0]} already exists.")
+            self._migrate_header_locked()
+            _append_rows(self.csv_path, records)
+            for record in records:
+                self._records[record['patient_id']] = record
+            self._signature = self._file_signature()
+        return [dict(record) for record in records]
+
+    def update_patient(self, patient_id, changes):
+        with self._lock, self._file_lock:
+            self._refresh_locked()
+            if patient_id not in self._records:
+                raise KeyError(patient_id)
+            record = dict(self._records[patient_id])
+            record.update({col: str(value or '') for col, value in changes.items() if col in PATIENT_COLUMNS and col != 'patient_id'})
+            self._migrate_header_locked()
+            _append_rows(self.journal_path, [record])
+            self._records[patient_id] = record
+            self._journal_entries += 1
+            self._signature = self._file_signature()
+            if self._journal_entries >= self.compact_threshold:
+                self._compact_locked()
+        return dict(record)
+
+    def replace_all(self, records):
+        with self._lock, self._file_lock:
+            self._records = {}
+            for record in records:
+                record = _normalize_record(record)
+                if record['patient_id']:
+                    self._records[record['patient_id']] = record
+            self._compact_locked()
+
+    def compact(self):
+        """Folds the journal into the CSV."""
+        with self._lock, self._file_lock:
+            self._refresh_locked()
+            self._compact_locked()
+
+    def _compact_locked(self):
+        directory = os.path.dirname(os.path.abspath(self.csv_path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.patients-', suffix='.csv', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=PATIENT_COLUMNS, lineterminator='\n')
+                writer.writeheader()
+                writer.writerows(self._records.values())
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o644)
+            # Bumped first: a reader that sees the new epoch with the old
+            # files just reloads them once more.
+            self._epoch = self._bump_epoch_locked()
+            os.replace(tmp_path, self.csv_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # Replaying a stale journal over the new CSV is harmless (entries
+        # are full rows), so a crash before this point loses nothing.
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._journal_entries = 0
+        self._headers_current = True
+        self._signature = self._file_signature()
+
+
+class SqlitePatientStore(PatientStore):
+    """
+    SQLite engine. patient_id is the primary key, so lookups and edits are
+    indexed row operations, and WAL mode lets readers in other workers carry
+    on while a write commits.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connect() as conn:
+            columns = ', '.join(f"{col} TEXT NOT NULL DEFAULT ''" for col in PATIENT_COLUMNS[1:])
+            conn.execute(f"CREATE TABLE IF NOT EXISTS patients (patient_id TEXT PRIMARY KEY, {columns})")
+            existing = {row[1] for row in conn.execute('PRAGMA table_info(patients)')}
+            for col in PATIENT_COLUMNS:
+                if col not in existing:
+                    conn.execute(f"ALTER TABLE patients ADD COLUMN {col} TEXT NOT NULL DEFAULT ''")
+
+    def _connect(self):
+        return thread_local_connection(self._local, self.db_path, row_factory=sqlite3.Row)
+
+    def get(self, patient_id):
+        row = self._connect().execute('SELECT * FROM patients WHERE patient_id = ?', (patient_id,)).fetchone()
+        return dict(row) if row else None
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM patients').fetchone()[0]
+
+    def records(self):
+        return [dict(row) for row in self._connect().execute('SELECT * FROM patients')]
+
+    def ids(self):
+        return [row[0] for row in self._connect().execute('SELECT patient_id FROM patients')]
+
+    def iter_records(self):
+        for row in self._connect().execute('SELECT * FROM patients'):
+            yield dict(row)
+
+    def add_patient(self, record):
+        return self.add_patients([record])[0]
+
+    def add_patients(self, records):
+        records = [_normalize_record(record) for record in records]
+        placeholders = ', '.join('?' for _ in PATIENT_COLUMNS)
+        try:
+            with self._connect() as conn:
+                conn.executemany(f"INSERT INTO patients ({', '.join(PATIENT_COLUMNS)}) VALUES ({placeholders})",
+                                 [[record[col] for col in PATIENT_COLUMNS] for record in records])
+        except sqlite3.IntegrityError as e:
+            raise ValueError(f"Patient already exists ({e}).")
+        return records
+
+    def update_patient(self, patient_id, changes):
+        changes = {col: str(value or '') for col, value in changes.items() if col in PATIENT_COLUMNS and col != 'patient_id'}
+        if changes:
+            assignments = ', '.join(f'{col} = ?' for col in changes)
+            with self._connect() as conn:
+                cursor = conn.execute(f'UPDATE patients SET {assignments} WHERE patient_id = ?',
+                                      [*changes.values(), patient_id])
+            if cursor.rowcount == 0:
+                raise KeyError(patient_id)
+        record = self.get(patient_id)
+        if record is None:
+            raise KeyError(patient_id)
+        return record
+
+    def replace_all(self, records):
+        rows = [_normalize_record(record) for record in records]
+        placeholders = ', '.join('?' for _ in PATIENT_COLUMNS)
+        with self._connect() as conn:
+            conn.execute('DELETE FROM patients')
+            conn.executemany(f"INSERT OR REPLACE INTO patients ({', '.join(PATIENT_COLUMNS)}) VALUES ({placeholders})",
+                             [[row[col] for col in PATIENT_COLUMNS] for row in rows if row['patient_id']])
+
+
+class ParquetPatientStore(PatientStore):
+    """
+    Columnar snapshot of the registry for analytics exports. Reads are
+    served from an in-memory index like the CSV engine, but every write
+    rewrites the file, so it suits read-mostly deployments rather than
+    sign-up heavy ones. Needs pandas with pyarrow.
+    """
+
+    def __init__(self, parquet_path):
+        self.parquet_path = parquet_path
+        self._file_lock = FileLock(parquet_path + '.lock')
+        self._lock = threading.RLock()
+        self._records = {}
+        self._signature = None
+
+    def _load(self):
+        if not os.path.exists(self.parquet_path):
+            return {}
+        import pandas as pd
+        df = pd.read_parquet(self.parquet_path).reindex(columns=PATIENT_COLUMNS).fillna('').astype(str)
+        return {record['patient_id']: record for record in df.to_dict('records') if record['patient_id']}
+
+    def refresh(self):
+        signature = file_signature(self.parquet_path)
+        if signature == self._signature:
+            return
+        with self._lock:
+            signature = file_signature(self.parquet_path)
+            if signature != self._signature:
+                self._records = self._load()
+                self._signature = signature
+
+    def get(self, patient_id):
+        self.refresh()
+        record = self._records.get(patient_id)
+        return dict(record) if record else None
+
+    def __len__(self):
+        self.refresh()
+        return len(self._records)
+
+    def records(self):
+        self.refresh()
+        return [dict(record) for record in self._records.values()]
+
+    def ids(self):
+        self.refresh()
+        return list(self._records)
+
+    def add_patient(self, record):
+        return self.add_patients([record])[0]
+
+    def add_patients(self, records):
+        records = [_normalize_record(record) for record in records]
+        with self._lock, self._file_lock:
+            self.refresh()
+            ids = [record['patient_id'] for record in records]
+            taken = [pid for pid in ids if pid in self._records]
+            if taken or len(set(ids)) != len(ids):
+                raise ValueError(f"Patient {(taken or ids)[0]} already exists.")
+            for record in records:
+                self._records[record['patient_id']] = record
+            self._write_locked()
+        return [dict(record) for record in records]
+
+    def update_patient(self, patient_id, changes):
+        with self._lock, self._file_lock:
+            self.refresh()
+            if patient_id not in self._records:
+                raise KeyError(patient_id)
+            record = dict(self._records[patient_id])
+            record.update({col: str(value or '') for col, value in changes.items() if col in PATIENT_COLUMNS and col != 'patient_id'})
+            self._records[patient_id] = record
+            self._write_locked()
+        return dict(record)
+
+    def replace_all(self, records):
+        with self._lock, self._file_lock:
+            self._records = {}
+            for record in records:
+                record = _normalize_record(record)
+                if record['patient_id']:
+                    self._records[record['patient_id']] = record
+            self._write_locked()
+
+    def _write_locked(self):
+        import pandas as pd
+        tmp_path = f'{self.parquet_path}.{os.getpid()}.tmp'
+        try:
+            pd.DataFrame(list(self._records.values()), columns=PATIENT_COLUMNS).to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, self.parquet_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._signature = file_signature(self.parquet_path)
+
+
+def parse_patient_number(patient_id):
+    """Returns the numeric part of a ``PATxxx`` ID, or None if it is not one."""
+    if not patient_id.startswith('PAT'):
+        return None
+    try:
+        return int(patient_id[3:])
+    except ValueError:
+        return None
+
+
+def format_patient_id(number):
+    return f"PAT{number:03d}"
+
+
+def max_patient_number(store, uploads_dir):
+    """
+    Highest patient number found in the registry or in the uploads folder
+    names. Only used once, to seed the ID sequence.
+    """
+    numbers = [parse_patient_number(pid) for pid in store.ids()]
+    try:
+        numbers += [parse_patient_number(name) for name in os.listdir(uploads_dir)]
+    except FileNotFoundError:
+        pass
+    return max([n for n in numbers if n is not None], default=0)
+
+
+class PatientIdSequence:
+    """
+    Persistent counter behind ``PATxxx`` IDs. The last issued number lives in
+    a small file that is read, incremented and rewritten under a
+    cross-process lock, so allocation is O(1) and never hands out the same ID
+    twice. ``seed`` is only called when the counter file does not exist yet
+    and must return the highest number already in use.
+    """
+
+    def __init__(self, counter_path, seed):
+        self.counter_path = counter_path
+        self.seed = seed
+        self._file_lock = FileLock(counter_path + '.lock')
+
+    def _read(self):
+        try:
+            with open(self.counter_path, encoding='utf-8') as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, value):
+        tmp_path = f'{self.counter_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(str(value))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.counter_path)
+
+    def reserve(self, count=1):
+        """Reserves ``count`` consecutive numbers and returns the first one."""
+        with self._file_lock:
+            last = self._read()
+            if last is None:
+                last = self.seed()
+            self._write(last + count)
+        return last + 1
+
+    def next_id(self):
+        return format_patient_id(self.reserve())
+
+
+def patient_store_path(backend, data_dir):
+    return os.path.join(data_dir, {'csv': 'patients.csv', 'sqlite': 'patients.db', 'parquet': 'patients.parquet'}[backend])
+
+
+def open_patient_store(backend, data_dir):
+    """Returns the storage engine named by ``backend`` (one of STORAGE_BACKENDS)."""
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend '{backend}'. Choose from: {', '.join(STORAGE_BACKENDS)}.")
+    path = patient_store_path(backend, data_dir)
+    if backend == 'sqlite':
+        return SqlitePatientStore(path)
+    if backend == 'parquet':
+        return ParquetPatientStore(path)
+    return CsvPatientStore(path)
+
+
+def migrate(source, target, data_dir):
+    """Copies every patient from one engine to another and returns the count."""
+    records = open_patient_store(source, data_dir).records()
+    open_patient_store(target, data_dir).replace_all(records)
+    return len(records)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MedVault patient storage tools.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help="Copy the patient registry into another storage engine.")
+    migrate_parser.add_argument('--from', dest='source', choices=STORAGE_BACKENDS, default='csv')
+    migrate_parser.add_argument('--to', dest='target', choices=STORAGE_BACKENDS, required=True)
+    migrate_parser.add_argument('--data-dir', default='data')
+    args = parser.parse_args(argv)
+
+    if args.source == args.target:
+        parser.error("--from and --to must name different engines.")
+    count = migrate(args.source, args.target, args.data_dir)
+    print(f"Migrated {count} patients from {args.source} to {patient_store_path(args.target, args.data_dir)}.")
+    print(f"Set MEDVAULT_STORAGE_BACKEND={args.target} to serve the app from it.")
+
+
+if __name__ == '__main__':
+    main()
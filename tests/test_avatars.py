@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+import avatars
+from avatars import AvatarPipeline
+
+
+@pytest.fixture
+def ready():
+    return []
+
+
+@pytest.fixture
+def pipeline(tmp_path, ready):
+    pipeline = AvatarPipeline(str(tmp_path / 'avatars'), on_ready=lambda patient_id, path: ready.append((patient_id, path)))
+    yield pipeline
+    pipeline._executor.shutdown(wait=True)
+
+
+def _picture(folder, data=None):
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder / 'profile_pic.png'
+    if data is None:
+        from PIL import Image
+        Image.new('RGB', (40, 30), 'red').save(path)
+    else:
+        path.write_bytes(data)
+    return str(path)
+
+
+def test_folder_without_a_picture_is_probed_once(pipeline, tmp_path, monkeypatch):
+    probes = []
+    find = avatars.find_legacy_profile_pic
+    monkeypatch.setattr(avatars, 'find_legacy_profile_pic', lambda folder: probes.append(folder) or find(folder))
+
+    assert pipeline.backfill('PAT001', str(tmp_path / 'PAT001')) is None
+    assert pipeline.backfill('PAT001', str(tmp_path / 'PAT001')) is None
+    assert len(probes) == 1
+
+
+def test_legacy_picture_is_converted_and_reported(pipeline, tmp_path, ready):
+    folder = tmp_path / 'PAT001'
+    _picture(folder)
+
+    display_path = pipeline.backfill('PAT001', str(folder)).result()
+
+    assert ready == [('PAT001', display_path)]
+    assert display_path.endswith('.jpg')
+
+
+def test_backfill_does_not_duplicate_a_submitted_job(pipeline, tmp_path, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    make_thumbnails = avatars.make_thumbnails
+
+    def slow(source_path, out_dir):
+        started.set()
+        release.wait(5)
+        return make_thumbnails(source_path, out_dir)
+
+    monkeypatch.setattr(avatars, 'make_thumbnails', slow)
+    folder = tmp_path / 'PAT001'
+    future = pipeline.submit('PAT001', _picture(folder))
+    started.wait(5)
+
+    assert pipeline.backfill('PAT001', str(folder)) is None
+    release.set()
+    assert future.result() is not None
+
+
+def test_undecodable_picture_is_logged_and_not_retried(pipeline, tmp_path, ready, caplog):
+    folder = tmp_path / 'PAT001'
+    _picture(folder, b'not an image')
+
+    assert pipeline.backfill('PAT001', str(folder)).result() is None
+    assert 'PAT001' in caplog.text
+    assert pipeline.backfill('PAT001', str(folder)) is None
+    assert ready == []
+
+    _picture(folder)
+    assert pipeline.submit('PAT001', str(folder / 'profile_pic.png')).result() is not None
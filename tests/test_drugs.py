@@ -0,0 +1,128 @@
+"""
+DrugInfoClient and LabelCache against a local http.server stand-in for the
+openFDA label endpoint.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from drugs import DrugInfoClient, LabelCache
+
+
+class FakeOpenFDA:
+    """Answers ``openfda.brand_name:"<name>"`` searches from ``labels``; unknown names get a 404."""
+
+    def __init__(self):
+        self.labels = {}
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                search = parse_qs(urlparse(self.path).query)['search'][0]
+                name = search.split('"')[1]
+                fake.requests.append(name)
+                label = fake.labels.get(name)
+                body = json.dumps({'results': [label]} if label else {'error': {'code': 'NOT_FOUND'}}).encode()
+                self.send_response(200 if label else 404)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/drug/label.json'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _label(purpose):
+    return {'purpose': [purpose], 'warnings': ['Do not exceed the stated dose.'], 'active_ingredient': ['Ibuprofen 200 mg']}
+
+
+@pytest.fixture
+def openfda():
+    fake = FakeOpenFDA()
+    yield fake
+    fake.close()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return LabelCache(str(tmp_path / 'openfda_cache.db'))
+
+
+def test_hit_is_served_from_cache(openfda, cache):
+    openfda.labels['ibuprofen'] = _label('Pain reliever')
+    client = DrugInfoClient(cache, base_url=openfda.url)
+
+    assert client.lookup('Ibuprofen')['Purpose'] == 'Pain reliever'
+    assert client.lookup('ibuprofen')['Purpose'] == 'Pain reliever'
+    assert openfda.requests == ['ibuprofen']
+
+
+def test_stale_label_is_served_and_refreshed_in_background(openfda, cache):
+    openfda.labels['ibuprofen'] = _label('Pain reliever')
+    client = DrugInfoClient(cache, base_url=openfda.url, ttl=0)
+    client.lookup('ibuprofen')
+    openfda.labels['ibuprofen'] = _label('Fever reducer')
+
+    assert client.lookup('ibuprofen')['Purpose'] == 'Pain reliever'
+    deadline = time.monotonic() + 5
+    while cache.get('ibuprofen')[0]['purpose'] != ['Fever reducer']:
+        assert time.monotonic() < deadline, "background refresh did not complete"
+        time.sleep(0.01)
+    assert openfda.requests == ['ibuprofen', 'ibuprofen']
+
+
+def test_not_found_is_cached(openfda, cache):
+    client = DrugInfoClient(cache, base_url=openfda.url)
+
+    assert client.lookup('nosuchdrug', 'Nosuchdrug') == {"Error": "No information found for 'Nosuchdrug'."}
+    assert client.lookup('nosuchdrug', 'Nosuchdrug') == {"Error": "No information found for 'Nosuchdrug'."}
+    assert openfda.requests == ['nosuchdrug']
+
+
+def test_offline_miss_never_calls_the_api(openfda, cache):
+    client = DrugInfoClient(cache, base_url=openfda.url, offline=True)
+
+    assert client.get_label('ibuprofen') == (False, None)
+    assert 'Offline mode' in client.lookup('ibuprofen')['Error']
+    assert openfda.requests == []
+
+
+def test_offline_serves_expired_labels(openfda, cache):
+    openfda.labels['ibuprofen'] = _label('Pain reliever')
+    DrugInfoClient(cache, base_url=openfda.url).lookup('ibuprofen')
+    client = DrugInfoClient(cache, base_url=openfda.url, offline=True, ttl=0, stale_ttl=0)
+
+    assert client.lookup('ibuprofen')['Purpose'] == 'Pain reliever'
+    assert openfda.requests == ['ibuprofen']
+
+
+def test_hits_only_rewrite_last_access_past_the_resolution(tmp_path):
+    cache = LabelCache(str(tmp_path / 'openfda_cache.db'), access_resolution=3600)
+    cache.put('ibuprofen', _label('Pain reliever'))
+    conn = cache._connect()
+
+    def last_access():
+        return conn.execute("SELECT last_access FROM labels WHERE us_name = 'ibuprofen'").fetchone()[0]
+
+    stored = last_access()
+    cache.get('ibuprofen')
+    assert last_access() == stored
+
+    conn.execute("UPDATE labels SET last_access = last_access - 7200")
+    conn.commit()
+    cache.get('ibuprofen')
+    assert last_access() > stored - 7200
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from drugs import DrugIndex
+from medications import MedicationIndex
+from storage import CsvPatientStore
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _record(n, current='', history=''):
+    return {'patient_id': f'PAT{n:03d}', 'name': f'Patient {n}', 'dob': '2000-01-01', 'blood_group': 'A+',
+            'current_medications': current, 'medication_history': history, 'pin': '1234'}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = CsvPatientStore(str(tmp_path / 'patients.csv'))
+    store.add_patients([_record(1, 'Crocin'), _record(2, 'Brufen'), _record(3, history='Aspirin')])
+    return store
+
+
+@pytest.fixture
+def index(tmp_path, store):
+    index = MedicationIndex(str(tmp_path / 'medications.db'), DrugIndex(os.path.join(REPO_ROOT, 'data', 'drug_map.csv')))
+    index.sync(store)
+    return index
+
+
+def test_sync_repairs_a_missed_update_with_the_same_patient_count(store, index):
+    # As if the app crashed between saving the record and updating the index.
+    store.update_patient('PAT002', {'current_medications': 'Dolo'})
+    assert index.patients_on('ibuprofen') == ['PAT002']
+
+    assert index.sync(store) == 1
+    assert index.patients_on('ibuprofen') == []
+    assert index.patients_on('acetaminophen') == ['PAT001', 'PAT002']
+    assert index.sync(store) == 0
+
+
+def test_sync_drops_patients_missing_from_a_restored_registry(store, index):
+    store.replace_all([_record(1, 'Crocin'), _record(2, 'Brufen'), _record(4, 'Aspirin')])
+
+    assert index.sync(store) == 2
+    assert index.patients_on('aspirin') == ['PAT004']
+
+
+def test_ensure_patient_reindexes_only_when_the_text_differs(store, index):
+    assert index.ensure_patient(store.get('PAT001')) is False
+
+    record = store.update_patient('PAT001', {'current_medications': 'Aspirin'})
+
+    assert index.ensure_patient(record) is True
+    assert index.medications('PAT001')['current'] == [('Aspirin', 'aspirin')]
@@ -0,0 +1,29 @@
+import os
+import subprocess
+import sys
+
+import metrics
+
+
+def test_const_labels_are_added_to_every_series():
+    registry = metrics.MetricsRegistry()
+    registry.inc('medvault_hits_total', result='hit')
+    registry.observe('medvault_load_seconds', 0.002)
+
+    series = [line for line in registry.render_prometheus(pid=42).splitlines() if not line.startswith('#')]
+
+    assert series
+    assert all('pid="42"' in line for line in series)
+    assert 'medvault_hits_total{pid="42",result="hit"} 1' in series
+
+
+def test_stale_textfiles_of_dead_processes_are_removed(tmp_path):
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    for pid in (os.getpid(), dead.pid):
+        (tmp_path / metrics.textfile_name('medvault', pid)).write_text('')
+    (tmp_path / 'other-1.prom').write_text('')
+
+    assert metrics.remove_stale_textfiles(str(tmp_path), 'medvault') == (1 if os.name == 'posix' else 0)
+    assert (tmp_path / metrics.textfile_name('medvault')).exists()
+    assert (tmp_path / 'other-1.prom').exists()
@@ -0,0 +1,37 @@
+import io
+
+from reports import BlobStore, ReportStore
+
+
+def _store(tmp_path, **kwargs):
+    return ReportStore(str(tmp_path / 'uploads'), str(tmp_path / 'manifests'), BlobStore(str(tmp_path / 'blobs')), **kwargs)
+
+
+def test_read_report_returns_the_uploaded_bytes(tmp_path):
+    store = _store(tmp_path)
+    data = bytes(range(256)) * 4096
+    name = store.save_report('PAT001', 'scan.pdf', io.BytesIO(data))
+    store.save_report('PAT001', 'empty.csv', io.BytesIO(b''))
+
+    assert store.read_report('PAT001', name) == data
+    assert store.read_report('PAT001', 'empty.csv') == b''
+
+
+def test_identical_uploads_share_one_blob(tmp_path):
+    store = _store(tmp_path)
+    store.save_report('PAT001', 'labs.csv', io.BytesIO(b'HbA1c,6.5\n'))
+    store.save_report('PAT002', 'labs.csv', io.BytesIO(b'HbA1c,6.5\n'))
+
+    blobs = [path for path in (tmp_path / 'blobs').rglob('*') if path.is_file()]
+    assert len(blobs) == 1
+
+
+def test_manifest_cache_keeps_the_most_recent_patients(tmp_path):
+    store = _store(tmp_path, max_patients=3)
+    for n in range(5):
+        store.save_report(f'PAT00{n}', 'labs.csv', io.BytesIO(f'{n}'.encode()))
+        store.manifest(f'PAT00{n}')
+    store.manifest('PAT002')
+
+    assert list(store._cache) == ['PAT003', 'PAT004', 'PAT002']
+    assert [entry['name'] for entry in store.manifest('PAT000')] == ['labs.csv']
@@ -0,0 +1,71 @@
+import io
+
+import pytest
+
+import search
+from reports import BlobStore, ReportStore
+from search import ReportIndexer, ReportSearchIndex
+
+
+@pytest.fixture
+def indexer(tmp_path):
+    store = ReportStore(str(tmp_path / 'uploads'), str(tmp_path / 'manifests'), BlobStore(str(tmp_path / 'blobs')))
+    indexer = ReportIndexer(store, ReportSearchIndex(str(tmp_path / 'search_index')))
+    yield indexer
+    indexer._executor.shutdown(wait=True)
+
+
+def _save(indexer, name, data):
+    indexer.report_store.save_report('PAT001', name, io.BytesIO(data))
+
+
+def test_backfill_indexes_a_patient_in_one_write(indexer, monkeypatch):
+    for n in range(5):
+        _save(indexer, f'labs{n}.csv', f'test,value\nHbA1c,{n}\n'.encode())
+    writes = []
+    add_documents = indexer.search_index.add_documents
+    monkeypatch.setattr(indexer.search_index, 'add_documents',
+                        lambda patient_id, documents: writes.append(len(documents)) or add_documents(patient_id, documents))
+
+    assert indexer.backfill('PAT001') == 5
+    indexer._executor.shutdown(wait=True)
+
+    assert writes == [5]
+    assert len(indexer.search_index.search('PAT001', 'hba1c')) == 5
+    assert indexer.backfill('PAT001') == 0
+
+
+def test_unsupported_reports_are_requeued_once_an_extractor_exists(indexer, monkeypatch):
+    _save(indexer, 'scan.pdf', b'%PDF-1.4 not really a pdf')
+    monkeypatch.setattr(search, 'can_extract', lambda name: False)
+    monkeypatch.setitem(search.EXTRACTORS, '.pdf', lambda path: None)
+    indexer.backfill('PAT001')
+    indexer._executor.shutdown(wait=True)
+    assert indexer.search_index.documents('PAT001')['scan.pdf']['status'] == 'unsupported'
+    assert indexer.backfill('PAT001') == 0
+
+    monkeypatch.setattr(search, 'can_extract', lambda name: True)
+    monkeypatch.setitem(search.EXTRACTORS, '.pdf', lambda path: 'Lipid panel')
+    indexer._executor = search.ThreadPoolExecutor(max_workers=1)
+
+    assert indexer.backfill('PAT001') == 1
+    indexer._executor.shutdown(wait=True)
+    assert indexer.search_index.documents('PAT001')['scan.pdf']['status'] == 'indexed'
+    assert [r['name'] for r in indexer.search_index.search('PAT001', 'lipid')] == ['scan.pdf']
+
+
+def test_failed_reports_are_retried_once_per_process(indexer, monkeypatch):
+    _save(indexer, 'broken.csv', b'x')
+
+    def fail(path):
+        raise ValueError("unreadable")
+
+    monkeypatch.setitem(search.EXTRACTORS, '.csv', fail)
+    indexer.backfill('PAT001')
+    indexer._executor.shutdown(wait=True)
+    assert indexer.search_index.documents('PAT001')['broken.csv']['status'] == 'failed'
+
+    indexer._executor = search.ThreadPoolExecutor(max_workers=1)
+    assert indexer.backfill('PAT001') == 1
+    indexer._executor.shutdown(wait=True)
+    assert indexer.backfill('PAT001') == 0
@@ -0,0 +1,93 @@
+import multiprocessing
+
+import pytest
+
+from share import MIN_SECRET_BYTES, ShareTokenSigner, load_or_create_secret
+
+NOW = 1_700_000_000
+
+
+@pytest.fixture
+def signer():
+    return ShareTokenSigner(b'k' * MIN_SECRET_BYTES)
+
+
+def test_issued_token_verifies(signer):
+    token = signer.issue('PAT014', 3, now=NOW)
+
+    assert token.startswith('PAT014.3.')
+    assert signer.verify(token, now=NOW) == ('PAT014', 3)
+
+
+def test_tampered_or_foreign_tokens_are_rejected(signer):
+    token = signer.issue('PAT014', 3, now=NOW)
+    patient_id, generation, expires, signature = token.split('.')
+
+    assert signer.verify(f'PAT015.{generation}.{expires}.{signature}', now=NOW) is None
+    assert signer.verify(f'{patient_id}.4.{expires}.{signature}', now=NOW) is None
+    assert signer.verify(f'{patient_id}.{generation}.{int(expires) + 86400}.{signature}', now=NOW) is None
+    assert ShareTokenSigner(b'x' * MIN_SECRET_BYTES).verify(token, now=NOW) is None
+    assert signer.verify('PAT014-1560', now=NOW) is None
+
+
+def test_token_expires(signer):
+    token = signer.issue('PAT014', 0, now=NOW)
+    expires = int(token.split('.')[2])
+
+    assert expires >= NOW + signer.ttl
+    assert signer.verify(token, now=expires) == ('PAT014', 0)
+    assert signer.verify(token, now=expires + 1) is None
+
+
+def test_generation_bump_revokes_earlier_tokens(signer):
+    # The caller compares the token's generation with the patient record's.
+    old = signer.issue('PAT014', 0, now=NOW)
+    new = signer.issue('PAT014', 1, now=NOW)
+    current_generation = 1
+
+    assert signer.verify(old, now=NOW)[1] != current_generation
+    assert signer.verify(new, now=NOW)[1] == current_generation
+
+
+def test_short_keys_are_refused(tmp_path):
+    with pytest.raises(ValueError):
+        ShareTokenSigner(b'')
+    path = tmp_path / 'share_secret.key'
+    path.write_bytes(b'')
+    with pytest.raises(ValueError):
+        load_or_create_secret(str(path))
+
+
+def test_secret_is_created_once_and_reused(tmp_path):
+    path = str(tmp_path / 'share_secret.key')
+    key = load_or_create_secret(path)
+
+    assert len(key) >= MIN_SECRET_BYTES
+    assert load_or_create_secret(path) == key
+    assert [p.name for p in tmp_path.iterdir()] == ['share_secret.key']
+
+
+def _load_after(barrier, path, results):
+    barrier.wait()
+    try:
+        results.put(load_or_create_secret(path))
+    except Exception as e:
+        results.put(repr(e))
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_concurrent_first_start_agrees_on_one_full_key(tmp_path):
+    context = multiprocessing.get_context('fork')
+    workers = 8
+    for trial in range(10):
+        path = str(tmp_path / f'share_secret_{trial}.key')
+        barrier, results = context.Barrier(workers), context.Queue()
+        processes = [context.Process(target=_load_after, args=(barrier, path, results)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+        keys = [results.get(timeout=30) for _ in processes]
+        for process in processes:
+            process.join()
+
+        assert len(set(keys)) == 1
+        assert isinstance(keys[0], bytes) and len(keys[0]) >= MIN_SECRET_BYTES
@@ -0,0 +1,38 @@
+from storage import CsvPatientStore
+
+
+def _record(n, **changes):
+    record = {'patient_id': f'PAT{n:03d}', 'name': f'Patient {n}', 'dob': '2000-01-01', 'blood_group': 'A+',
+              'current_medications': '', 'medication_history': '', 'pin': '1234'}
+    record.update(changes)
+    return record
+
+
+def test_idle_instance_reloads_after_compactions(tmp_path):
+    # Compaction recreates the CSV, and the filesystem may hand the new file
+    # the old inode; the idle instance must not resume from its old offset.
+    path = str(tmp_path / 'patients.csv')
+    writer = CsvPatientStore(path, compact_threshold=5)
+    idle = CsvPatientStore(path, compact_threshold=5)
+    for trial in range(20):
+        writer.add_patients([_record(trial * 100 + n) for n in range(20)])
+        assert len(idle) == len(writer)
+        for k in range(12):
+            writer.update_patient(f'PAT{trial * 100 + 1:03d}', {'name': f'Renamed {k}' * (k + 1), 'pin': str(1000 + k)})
+
+        assert idle.records() == writer.records()
+        assert idle.get(f'PAT{trial * 100 + 1:03d}')['pin'] == '1011'
+
+
+def test_appends_from_another_instance_are_picked_up(tmp_path):
+    path = str(tmp_path / 'patients.csv')
+    writer = CsvPatientStore(path)
+    reader = CsvPatientStore(path)
+    writer.add_patient(_record(1))
+    assert reader.get('PAT001')['name'] == 'Patient 1'
+
+    writer.add_patient(_record(2))
+    writer.update_patient('PAT001', {'pin': '9999'})
+
+    assert len(reader) == 2
+    assert reader.get('PAT001')['pin'] == '9999'